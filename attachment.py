@@ -0,0 +1,167 @@
+from concurrency import parallel_map
+from config import Config
+from contextlib import ExitStack
+from jiratools import JiraTools
+from journal import Journal
+from profiler import Profiler
+import hashlib
+import json
+import os
+import logging
+import threading
+
+class Attachment:
+    """
+    Class to store the files attached to an issue.
+    The files are not loaded when the object is created: they are downloaded afterwards by download_all()
+    """
+    chunk_size = 64 * 1024
+    __slots__ = ('id', 'filename', 'author', 'created', 'size', 'mimeType', 'url', 'localfile', 'hash')
+    uploaded = {}  # content hash -> Clubhouse file id, persisted in the attachments folder across runs
+    workspace = None  # the file ids are only valid in one Clubhouse workspace (see set_workspace)
+    max_batch = 4  # the upload endpoint of Clubhouse accepts at most 4 files (file0 to file3) per request
+    _uploaded_lock = threading.Lock()
+
+    def __init__(self, jira_attachment):
+        self.id = jira_attachment.id
+        self.filename = jira_attachment.filename
+        self.author = Config.get('users').get(jira_attachment.author.name)
+        self.created = jira_attachment.created
+        self.size = jira_attachment.size
+        self.mimeType = jira_attachment.mimeType
+        self.url = jira_attachment.content
+        # files are stored by Jira id, so that attachments with the same name on different issues do not collide
+        folder = Config.get("attachments").get('folder')
+        self.localfile = os.path.join(folder, str(self.id), os.path.basename(self.filename))
+        self.hash = None
+
+    @property
+    def target(self):
+        """Clubhouse id of the uploaded file (None until it is uploaded), kept in the journal"""
+        return Journal.get('files', str(self.id))
+
+    @target.setter
+    def target(self, id):
+        Journal.record('files', str(self.id), id)
+
+    def is_downloaded(self):
+        return os.path.exists(self.localfile) and os.path.getsize(self.localfile) == self.size
+
+    @Profiler.timed("Attachment.download", items=int)
+    def download(self, jira_client):
+        """
+        Streams the file to disk (in chunks), unless it was already downloaded by a previous run
+        :return: True if the file has been downloaded
+        """
+        if self.is_downloaded():
+            return False
+        os.makedirs(os.path.dirname(self.localfile), exist_ok=True)
+        partial = self.localfile + ".part"
+        response = JiraTools.throttle.call(jira_client._session.get, self.url, stream=True)
+        with open(partial, 'wb') as f:
+            for chunk in response.iter_content(self.chunk_size):
+                f.write(chunk)
+        os.replace(partial, self.localfile)  # a file is never left half written under its final name
+        return True
+
+    @classmethod
+    def download_all(cls, jira_client, attachments):
+        """Downloads the attachments in parallel (configuration parameter 'attachments' / 'workers', default 4)"""
+        attachments = list(attachments)
+        workers = Config.get("attachments").get('workers', 4)
+        downloaded = parallel_map(lambda a: a.download(jira_client), attachments, workers)
+        logging.info("Attachments: {} downloaded, {} already present".format(
+            downloaded.count(True), downloaded.count(False)))
+
+    def digest(self):
+        """Returns (and keeps) the SHA-256 of the downloaded file"""
+        if not self.hash:
+            sha = hashlib.sha256()
+            with open(self.localfile, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    sha.update(chunk)
+            self.hash = sha.hexdigest()
+        return self.hash
+
+    @classmethod
+    def set_workspace(cls, token):
+        """Scopes the table of the uploaded files to a Clubhouse token (a token gives access to one workspace)"""
+        cls.workspace = hashlib.sha256(token.encode()).hexdigest()[:16]
+        cls.uploaded = {}
+
+    @classmethod
+    def batch_size(cls):
+        """Number of files sent per upload request ('attachments' / 'batch_size', at most max_batch)"""
+        return max(1, min(Config.get("attachments").get('batch_size', cls.max_batch), cls.max_batch))
+
+    @classmethod
+    def check_uploaded(cls, sent, response):
+        """Raises an error if Clubhouse did not answer with one file per file sent"""
+        if len(response) != len(sent):
+            raise ValueError("Upload of {} files answered with {} files".format(len(sent), len(response)))
+
+    @classmethod
+    def upload_table(cls):
+        name = "uploads-{}.json".format(cls.workspace) if cls.workspace else "uploads.json"
+        return os.path.join(Config.get("attachments").get('folder'), name)
+
+    @classmethod
+    def load_uploaded(cls):
+        try:
+            with open(cls.upload_table()) as f:
+                cls.uploaded = json.load(f)
+        except (OSError, IOError, ValueError):
+            cls.uploaded = {}
+
+    @classmethod
+    def _record_uploaded(cls, ids):
+        with cls._uploaded_lock:
+            cls.uploaded.update(ids)
+            os.makedirs(os.path.dirname(cls.upload_table()), exist_ok=True)
+            with open(cls.upload_table() + ".tmp", 'w') as f:
+                json.dump(cls.uploaded, f)
+            os.replace(cls.upload_table() + ".tmp", cls.upload_table())
+
+    @classmethod
+    def upload_all(cls, clubhouse, attachments):
+        """
+        Uploads the attachments before the stories are created, so that the stories can reference their ids.
+        - identical files, and files already uploaded by a previous run, are sent only once (by content hash)
+        - several files are sent per request ('attachments' / 'batch_size', default and maximum 4)
+        - requests run in parallel ('attachments' / 'workers', default 4)
+        """
+        attachments = [a for a in attachments if not a.target]
+        workers = Config.get("attachments").get('workers', 4)
+        batch_size = cls.batch_size()
+        with cls._uploaded_lock:  # several projects may be uploading at the same time
+            if not cls.uploaded:
+                cls.load_uploaded()
+        parallel_map(lambda a: a.digest(), attachments, workers)
+        pending = list({a.hash: a for a in attachments if a.hash not in cls.uploaded}.values())
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        parallel_map(lambda b: cls._upload_batch(clubhouse, b), batches, workers)
+        for a in attachments:
+            a.target = cls.uploaded[a.hash]
+        logging.info("Attachments: {} uploaded in {} requests, {} reused".format(
+            len(pending), len(batches), len(attachments) - len(pending)))
+
+    @classmethod
+    @Profiler.timed("Attachment.upload", items=len)
+    def _upload_batch(cls, clubhouse, batch):
+        with ExitStack() as stack:
+            files = {"file{}".format(i): (a.filename, stack.enter_context(open(a.localfile, 'rb')), a.mimeType)
+                     for i, a in enumerate(batch)}
+            response = clubhouse.post('files', files=files)
+        cls.check_uploaded(batch, response)
+        cls._record_uploaded({a.digest(): f["id"] for a, f in zip(batch, response)})
+        return batch
+
+    @Profiler.timed("Attachment.upload")
+    def save(self, clubhouse):
+        """
+        Upload a file to the server
+        """
+        with open(self.localfile, 'rb') as f:
+            response = clubhouse.post('files', files={"file": (self.filename, f, self.mimeType)})
+        self.target = response[0]["id"]
+        return self.target
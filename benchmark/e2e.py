@@ -0,0 +1,181 @@
+"""
+End-to-end benchmark of the migration, against local stand-ins of Jira and Clubhouse (see standins.py):
+the steps of jira2clubhouse.py (registries, load, download, save, links) are run on synthetic projects, and for each
+phase the wall time, the peak memory allocated by Python (tracemalloc) and the requests per endpoint are reported.
+Usage: python benchmark/e2e.py [--projects 1] [--epics 5] [--stories 10] [--no_epic 10] [--subtasks 1] [--comments 2]
+                               [--attachments 1] [--attachment_size 10000] [--links 1] [--sprints 4]
+                               [--latency 0.01] [--throttled 0.0] [--retry_after 0.1]
+                               [--jira_workers 4] [--clubhouse_workers 4] [--rate_limit 60000] [--bulk] [--scan]
+                               [--inline_watchers] [--no_memory] [--estimate] [--export] [--json report.json]
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import clubhouse
+from jira import JIRA
+from concurrency import Throttle, ThrottledClient, TokenBucket
+from config import Config
+from estimate import Estimate
+from jiratools import JiraTools
+from link import Link
+from payloads import Exporter, Loader
+from project import Project
+from registry import Members, EpicStates, StoryStates
+from resolver import Resolver
+from standins import JiraStandIn, ClubhouseStandIn
+from transport import CachedClient, SessionClient, pool
+
+
+class Phases:
+    """Measures the phases of the run: wall time, peak memory and requests sent to each stand-in"""
+    def __init__(self, standins, memory=True):
+        self.standins = standins
+        self.memory = memory
+        self.results = OrderedDict()
+        self.name = None
+
+    def __call__(self, name):
+        self.name = name
+        return self
+
+    def __enter__(self):
+        self.counts = {n: Counter(s.counts) for n, s in self.standins.items()}
+        if self.memory:
+            tracemalloc.reset_peak()
+            self.baseline = tracemalloc.get_traced_memory()[0]
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        peak = tracemalloc.get_traced_memory()[1] - self.baseline if self.memory else 0
+        result = self.results.setdefault(self.name, {"seconds": 0.0, "peak_bytes": 0,
+                                                     "requests": {n: Counter() for n in self.standins}})
+        result["seconds"] += elapsed
+        result["peak_bytes"] = max(result["peak_bytes"], peak)
+        for n, s in self.standins.items():
+            result["requests"][n].update(Counter(s.counts) - self.counts[n])
+
+    def report(self):
+        print("{:<12}{:>10}{:>12}{:>10}{:>12}".format("phase", "time (s)", "peak (MB)", "jira", "clubhouse"))
+        for name, r in self.results.items():
+            print("{:<12}{:>10.2f}{:>12.1f}{:>10}{:>12}".format(
+                name, r["seconds"], r["peak_bytes"] / 2 ** 20,
+                sum(r["requests"]["jira"].values()), sum(r["requests"]["clubhouse"].values())))
+        print("{:<12}{:>10.2f}".format("total", sum(r["seconds"] for r in self.results.values())))
+        for name, r in self.results.items():
+            for standin, counts in r["requests"].items():
+                for endpoint, n in sorted(counts.items()):
+                    print("  {:<12}{:<10}{:<48}{:>6}".format(name, standin, endpoint, n))
+
+    def json(self):
+        return {name: dict(r, requests={n: dict(c) for n, c in r["requests"].items()})
+                for name, r in self.results.items()}
+
+
+def configuration(folder, rate_limit):
+    """The configuration of the migration, mapping the synthetic data to the Clubhouse stand-in"""
+    return {
+        "attachments": {"folder": folder},
+        "clubhouse": {"rate_limit": rate_limit},
+        "sprints": {"iterations": True},
+        "users": {"bench": "bench"},
+        "issue_states": {"Done": "Completed"},
+        "subtask_states": {"Done": True},
+        "epic_states": {"Done": "done"},
+        "link_types": {"Blocks": "blocks"},
+        "story_types": {"Story": "feature", "Sub-task": None, "Epic": None},
+    }
+
+
+def run(args):
+    jira = JiraStandIn(projects=["BENCH{}".format(n + 1) for n in range(args.projects)], epics=args.epics,
+                       stories=args.stories, no_epic=args.no_epic, subtasks=args.subtasks, comments=args.comments,
+                       attachments=args.attachments, attachment_size=args.attachment_size, links=args.links,
+                       sprints=args.sprints, inline_watchers=args.inline_watchers, latency=args.latency,
+                       throttled=args.throttled, retry_after=args.retry_after).start()
+    ch = ClubhouseStandIn(latency=args.latency, throttled=args.throttled, retry_after=args.retry_after).start()
+    clubhouse.ENDPOINT_HOST = ch.url
+    folder = tempfile.mkdtemp(prefix="jira2clubhouse-bench-")
+    Config.dict = configuration(folder, args.rate_limit)
+    if not args.no_memory:
+        tracemalloc.start()
+    phase = Phases({"jira": jira, "clubhouse": ch}, memory=not args.no_memory)
+    try:
+        with phase("registries"):
+            clubhouse_client = CachedClient(ThrottledClient(
+                SessionClient("bench", max(args.clubhouse_workers, 4)),
+                Throttle(args.clubhouse_workers, retry_statuses=(429, 500, 502, 503, 504), bucket=TokenBucket(args.rate_limit))))
+            Members.init(clubhouse_client)
+            StoryStates.init(clubhouse_client)
+            EpicStates.init(clubhouse_client)
+            Resolver.compile()
+        with phase("connect"):
+            jira_client = JIRA(jira.url, basic_auth=("bench", "bench"))
+            pool(jira_client._session, max(args.jira_workers, 4))
+            JiraTools.set_workers(args.jira_workers)
+        if args.estimate:  # to compare the estimate with the measures of the run
+            with phase("estimate"):
+                estimates = [Estimate(jira_client, key, scan=args.scan, bulk=args.bulk) for key in jira.projects]
+            print(Estimate.report(estimates, Estimate.clubhouse_latency(clubhouse_client), args.clubhouse_workers))
+        # with --export, the payloads are written to a file (save and links), then the file is loaded
+        exporter = Exporter(os.path.join(folder, "payloads.jsonl")) if args.export else None
+        links = []
+        for key in jira.projects:
+            with phase("load"):
+                project = Project(jira_client, key, scan=args.scan)
+            if not Resolver.check():
+                raise ValueError("The benchmark configuration does not map the synthetic data")
+            with phase("download"):
+                project.download_attachments(jira_client)
+            with phase("save"):
+                if exporter:
+                    exporter.export(project, bulk=args.bulk)
+                else:
+                    project.save(clubhouse_client, bulk=args.bulk, workers=args.clubhouse_workers)
+            links += project.links()
+        with phase("links"):
+            Link.save_all(exporter or clubhouse_client, links, args.clubhouse_workers)
+        if exporter:
+            exporter.close()
+            with phase("replay"):
+                Loader(clubhouse_client).load(exporter.path)
+    finally:
+        jira.stop()
+        ch.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    return phase
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    for name, default in (('projects', 1), ('epics', 5), ('stories', 10), ('no_epic', 10), ('subtasks', 1),
+                          ('comments', 2), ('attachments', 1), ('attachment_size', 10000), ('links', 1),
+                          ('sprints', 4), ('jira_workers', 4), ('clubhouse_workers', 4), ('rate_limit', 60000)):
+        parser.add_argument('--' + name, type=int, default=default)
+    parser.add_argument('--latency', type=float, default=0.01)  # seconds added to every answer of the stand-ins
+    parser.add_argument('--throttled', type=float, default=0.0)  # fraction of the requests answered with 429
+    parser.add_argument('--retry_after', type=float, default=0.1)  # Retry-After header of the 429 answers
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--scan', action='store_true')
+    parser.add_argument('--inline_watchers', action='store_true')  # the searches include the watchers (not like Jira)
+    parser.add_argument('--no_memory', action='store_true')  # no tracemalloc: the times are not slowed down by it
+    parser.add_argument('--estimate', action='store_true')  # also print the estimate of the run (see estimate.py)
+    parser.add_argument('--export', action='store_true')  # export the payloads to a file, then load it (see payloads.py)
+    parser.add_argument('--json')  # also write the results to this file
+    parser.add_argument('--log', default=logging.WARNING)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log)
+    phases = run(args)
+    phases.report()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"arguments": vars(args), "phases": phases.json()}, f, indent=2)
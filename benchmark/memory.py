@@ -0,0 +1,69 @@
+"""
+Measures the memory footprint per issue of the migration model, with synthetic Jira payloads:
+- before: the Story objects and the jira.Issue resources they used to keep (Issue.source)
+- now: the Story objects alone, once the Jira resources have been freed
+Usage: python benchmark/memory.py [number of issues] [comments per issue]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from jira.resources import Issue as JiraIssue
+from config import Config
+from registry import Members, StoryStates
+from resolver import Resolver
+from issue import Story
+
+OPTIONS = {'server': 'http://jira', 'rest_path': 'api', 'rest_api_version': '2', 'context_path': '/',
+           'agile_rest_path': 'agile', 'agile_rest_api_version': '1.0'}
+
+
+def raw_issue(n, comments):
+    user = {"key": "user", "name": "user", "displayName": "A User", "emailAddress": "user@example.com",
+            "avatarUrls": {size: "https://avatars.example.com/user/{}".format(size) for size in ("16x16", "24x24", "32x32", "48x48")}}
+    return {
+        "key": "BENCH-{}".format(n), "id": str(10000 + n), "self": "http://jira/rest/api/2/issue/{}".format(10000 + n),
+        "fields": {
+            "summary": "Synthetic issue number {}".format(n), "description": "Lorem ipsum dolor sit amet. " * 20,
+            "created": "2020-01-01T10:00:00.000+0000", "updated": "2020-01-02T10:00:00.000+0000", "duedate": None,
+            "assignee": user, "reporter": user, "components": [], "attachment": [], "issuelinks": [],
+            "issuetype": {"name": "Story", "description": "A user story", "iconUrl": "http://jira/story.png"},
+            "status": {"name": "Done", "description": "Finished", "iconUrl": "http://jira/done.png",
+                       "statusCategory": {"key": "done", "colorName": "green"}},
+            "subtasks": [], "customfield_10005": None, "customfield_10115": None,
+            "watches": {"watchCount": 0, "isWatching": False, "self": "http://jira/watchers"},
+            "comment": {"comments": [{"id": str(c), "author": user, "updateAuthor": user, "body": "A comment. " * 30,
+                                      "created": "2020-01-01T10:00:00.000+0000", "updated": "2020-01-01T10:00:00.000+0000"}
+                                     for c in range(comments)], "total": comments},
+        }}
+
+
+def footprint(count, comments):
+    """Returns the memory retained by the model before (records + jira resources) and now (records only)"""
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    resources = [JiraIssue(OPTIONS, None, raw=raw_issue(n, comments)) for n in range(count)]
+    records = [Story(None, r) for r in resources]
+    before = tracemalloc.get_traced_memory()[0] - baseline
+    del resources  # the records do not reference the resources: they are freed here
+    gc.collect()
+    now = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    return records, before, now
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    comments = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    Config.dict = {"users": {"user": "user"}, "issue_states": {"Done": "Completed"}, "story_types": {"Story": "feature"},
+                   "link_types": {}, "epic_states": {}, "subtask_states": {}, "attachments": {"folder": "/tmp"}}
+    Members.items = {"user": "member-id"}
+    StoryStates.items = {"Completed": 500}
+    Resolver.compile()
+
+    records, before, now = footprint(count, comments)
+    print("{} issues with {} comments each".format(count, comments))
+    print("with the jira resources: {:8.0f} bytes per issue (before)".format(before / count))
+    print("records only:            {:8.0f} bytes per issue (now)".format(now / count))
@@ -0,0 +1,365 @@
+"""
+Local HTTP stand-ins for the Jira REST API and the Clubhouse API, for the end-to-end benchmark (see e2e.py).
+They serve the endpoints used by the migration, with synthetic projects, and may inject latency and 429 answers.
+Every request is counted by endpoint (the ids in the path are replaced with '{id}'; the throttled requests are counted
+apart, with a '429' prefix).
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import random
+import re
+import threading
+import time
+
+
+class StandIn:
+    """
+    Base class of the stand-ins: a threaded HTTP server on a free local port, with the routes of the subclass.
+    :param latency: seconds added to every answer
+    :param throttled: fraction of the requests answered with 429 (Too Many Requests)
+    :param retry_after: value of the Retry-After header sent with the 429 answers
+    """
+    routes = []  # (method, path regex, name of the handler method)
+    prefix = ''  # removed from the paths in the request counts
+
+    def __init__(self, latency=0.0, throttled=0.0, retry_after=None, seed=0):
+        self.latency = latency
+        self.throttled = throttled
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, method, path):
+        """Returns the handler of a request, its arguments (the groups of the path) and the endpoint name"""
+        for m, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if m == method and match:
+                endpoint = path
+                for i in reversed(range(1, len(match.groups()) + 1)):
+                    if match.group(i) and re.search('[0-9]', match.group(i)):
+                        endpoint = endpoint[:match.start(i)] + '{id}' + endpoint[match.end(i):]
+                if endpoint.startswith(self.prefix):
+                    endpoint = endpoint[len(self.prefix):]
+                return getattr(self, name), match.groups(), "{} {}".format(method, endpoint)
+        return None, (), "{} {}".format(method, path)
+
+    def handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # the headers and the body are written separately, as on real servers
+
+            def log_message(self, *args):
+                pass
+
+            def answer(self, method):
+                url = urlparse(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                function, arguments, endpoint = standin.route(method, url.path)
+                with standin.lock:
+                    throttled = standin.random.random() < standin.throttled
+                    standin.counts[("429 " if throttled else "") + endpoint] += 1
+                if standin.latency:
+                    time.sleep(standin.latency)
+                if throttled:
+                    headers = {'Retry-After': str(standin.retry_after)} if standin.retry_after is not None else {}
+                    return self.send(429, {"message": "Too Many Requests"}, headers)
+                if not function:
+                    return self.send(404, {"message": "No route for {} {}".format(method, url.path)})
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                try:
+                    status, content = function(body, query, *arguments)
+                except Exception as e:
+                    status, content = 400, {"message": repr(e)}
+                self.send(status, content)
+
+            def send(self, status, content, headers=None):
+                data = content if isinstance(content, bytes) else json.dumps(content).encode()
+                self.send_response(status)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header('Content-Type', 'application/octet-stream' if isinstance(content, bytes)
+                                 else 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.answer('GET')
+
+            def do_POST(self):
+                self.answer('POST')
+
+            def do_PUT(self):
+                self.answer('PUT')
+
+            def do_DELETE(self):
+                self.answer('DELETE')
+
+        return Handler
+
+
+class JiraStandIn(StandIn):
+    """
+    Jira Cloud stand-in, seeded with synthetic projects:
+    each project has 'epics' epics of 'stories' stories, 'no_epic' stories without epic, 'subtasks' subtasks per story,
+    'comments' comments per issue, 'attachments' files of 'attachment_size' bytes per story, 'links' links per story
+    (to other stories of the project) and 'sprints' sprints on a scrum board, the stories being spread over the sprints.
+    Like Jira, the searches only give the number of watchers, which are requested separately; with 'inline_watchers',
+    the watchers are also included in the search results (see JiraTools.issue_watchers)
+    """
+    user = {"key": "bench", "name": "bench", "displayName": "Bench User"}
+    prefix = '/rest/'
+    routes = [
+        ('GET', r'/rest/api/2/serverInfo', 'server_info'),
+        ('GET', r'/rest/api/2/field', 'fields'),
+        ('GET', r'/rest/api/2/project/([^/]+)', 'project'),
+        ('GET', r'/rest/api/2/search', 'search'),
+        ('GET', r'/rest/api/2/issue/([^/]+)/watchers', 'watchers'),
+        ('GET', r'/rest/agile/1.0/board', 'board_list'),
+        ('GET', r'/rest/agile/1.0/board/([0-9]+)/sprint', 'board_sprints'),
+        ('GET', r'/rest/agile/1.0/sprint/([0-9]+)', 'sprint'),
+        ('GET', r'/secure/attachment/([0-9]+)/(.*)', 'content'),
+    ]
+
+    def __init__(self, projects=('BENCH',), epics=5, stories=10, no_epic=10, subtasks=1, comments=2, attachments=1,
+                 attachment_size=10000, links=1, sprints=4, inline_watchers=False, **options):
+        super().__init__(**options)
+        self.attachment_size = attachment_size
+        self.inline_watchers = inline_watchers
+        self.projects = {}
+        self.issues = []  # in key order, as sorted by the searches
+        self.sprints = {}
+        self.boards = {}
+        rng = random.Random(1)
+        sequence = iter(range(10000, 10 ** 9))
+        for p, key in enumerate(projects):
+            self.projects[key] = {"key": key, "id": str(100 + p), "name": "Benchmark {}".format(key),
+                                  "description": "Synthetic project", "lead": self.user}
+            board = p + 1
+            self.boards[board] = key
+            ids = [next(sequence) for _ in range(sprints)]
+            for n, id in enumerate(ids):
+                self.sprints[id] = {"id": id, "name": "{} Sprint {}".format(key, n + 1), "state": "closed",
+                                    "originBoardId": board, "startDate": "2020-0{}-01T00:00:00.000Z".format(n % 9 + 1),
+                                    "endDate": "2020-0{}-14T00:00:00.000Z".format(n % 9 + 1)}
+            number = iter(range(1, 10 ** 9))
+            issues = []
+            stories_keys = []
+            for e in range(epics):
+                epic = self.issue(key, next(number), "Epic", comments, sequence)
+                issues.append(epic)
+                for s in range(stories):
+                    stories_keys.append(self.story(issues, key, number, epic["key"], subtasks, comments, attachments,
+                                                   ids, sequence, rng))
+            for s in range(no_epic):
+                stories_keys.append(self.story(issues, key, number, None, subtasks, comments, attachments,
+                                               ids, sequence, rng))
+            by_key = {i["key"]: i for i in issues}
+            for story in stories_keys:
+                targets = rng.sample(stories_keys, min(links, len(stories_keys)))
+                by_key[story]["fields"]["issuelinks"] = [
+                    {"id": str(next(sequence)), "type": {"name": "Blocks", "inward": "is blocked by", "outward": "blocks"},
+                     "outwardIssue": {"key": t}} for t in targets if t != story]
+            self.issues.extend(issues)
+
+    def issue(self, project, number, issuetype, comments, sequence, epic=None, parent=None):
+        key = "{}-{}".format(project, number)
+        return {"id": str(next(sequence)), "key": key, "self": "{}/rest/api/2/issue/{}".format(self.url, key), "fields": {
+            "summary": "{} {}".format(issuetype, key), "description": "Synthetic description. " * 10,
+            "created": "2020-01-01T10:00:00.000+0000", "updated": "2020-01-02T10:00:00.000+0000", "duedate": None,
+            "assignee": self.user, "reporter": self.user, "components": [], "attachment": [], "issuelinks": [],
+            "issuetype": {"name": issuetype}, "status": {"name": "Done"}, "subtasks": [],
+            "customfield_10005": epic, "customfield_10115": None, "parent": {"key": parent} if parent else None,
+            "watches": dict({"watchCount": 1, "isWatching": False},
+                            **({"watchers": [self.user]} if self.inline_watchers else {})),
+            "comment": {"comments": [{"id": str(next(sequence)), "author": self.user, "body": "A comment. " * 10,
+                                      "created": "2020-01-01T10:00:00.000+0000"} for _ in range(comments)],
+                        "total": comments},
+        }}
+
+    def story(self, issues, project, number, epic, subtasks, comments, attachments, sprints, sequence, rng):
+        story = self.issue(project, next(number), "Story", comments, sequence, epic=epic)
+        fields = story["fields"]
+        if sprints:
+            sprint = self.sprints[rng.choice(sprints)]
+            fields["customfield_10115"] = ["com.atlassian.greenhopper.service.sprint.Sprint@1[id={},rapidViewId={},"
+                                           "state=CLOSED,name={},sequence={}]".format(sprint["id"], sprint["originBoardId"],
+                                                                                      sprint["name"], sprint["id"])]
+        for a in range(attachments):
+            id = next(sequence)
+            fields["attachment"].append({"id": str(id), "filename": "file{}.bin".format(a), "author": self.user,
+                                         "created": "2020-01-01T10:00:00.000+0000", "size": self.attachment_size,
+                                         "mimeType": "application/octet-stream",
+                                         "content": "{}/secure/attachment/{}/file{}.bin".format(self.url, id, a)})
+        issues.append(story)
+        for t in range(subtasks):
+            subtask = self.issue(project, next(number), "Sub-task", 0, sequence, parent=story["key"])
+            fields["subtasks"].append({"key": subtask["key"]})
+            issues.append(subtask)
+        return story["key"]
+
+    def matches(self, issue, clause):
+        fields = issue["fields"]
+        for pattern, test in (
+                (r"project = '(.*)'", lambda v: issue["key"].rsplit("-", 1)[0] == v),
+                (r"issuetype = '(.*)'", lambda v: fields["issuetype"]["name"] == v),
+                (r"issuetype != '(.*)'", lambda v: fields["issuetype"]["name"] != v),
+                (r"'Epic Link' = '(.*)'", lambda v: fields["customfield_10005"] == v),
+                (r"'Epic Link' is EMPTY()", lambda v: not fields["customfield_10005"]),
+                (r"'Epic Link' is not EMPTY()", lambda v: bool(fields["customfield_10005"])),
+                (r"parent = '(.*)'", lambda v: (fields["parent"] or {}).get("key") == v)):
+            match = re.fullmatch(pattern, clause)
+            if match:
+                return test(match.group(1))
+        raise ValueError("Unsupported JQL clause: {}".format(clause))
+
+    # routes
+    def server_info(self, body, query):
+        return 200, {"baseUrl": self.url, "version": "1001.0.0", "versionNumbers": [1001, 0, 0],
+                     "deploymentType": "Cloud"}
+
+    def fields(self, body, query):
+        return 200, []
+
+    def project(self, body, query, key):
+        return (200, self.projects[key]) if key in self.projects else (404, {"errorMessages": ["No project"]})
+
+    def search(self, body, query):
+        clauses = [c.strip() for c in re.split(r" order by ", query.get("jql", ""))[0].split(" and ") if c.strip()]
+        found = [i for i in self.issues if all(self.matches(i, c) for c in clauses)]
+        start = int(query.get("startAt", 0))
+        size = min(int(query.get("maxResults", 50)), 100)  # Jira Cloud answers at most 100 issues per page
+        return 200, {"startAt": start, "maxResults": size, "total": len(found), "issues": found[start:start + size]}
+
+    def watchers(self, body, query, key):
+        return 200, {"watchCount": 1, "watchers": [self.user]}
+
+    def board_list(self, body, query):
+        project = query.get("projectKeyOrId")
+        return 200, {"isLast": True, "values": [{"id": id, "type": "scrum"} for id, key in self.boards.items()
+                                                if key == project]}
+
+    def board_sprints(self, body, query, board):
+        return 200, {"isLast": True, "values": [s for s in self.sprints.values() if s["originBoardId"] == int(board)]}
+
+    def sprint(self, body, query, id):
+        return 200, self.sprints[int(id)]
+
+    def content(self, body, query, id, filename):
+        return 200, (id.encode() * self.attachment_size)[:self.attachment_size]
+
+
+class ClubhouseStandIn(StandIn):
+    """
+    Clubhouse API (v2) stand-in: the created objects are kept in memory, the workspace has one member ('bench')
+    and the workflow states used by the benchmark configuration
+    """
+    prefix = '/api/v2/'
+    routes = [
+        ('GET', r'/api/v2/members', 'members'),
+        ('GET', r'/api/v2/epic-workflow', 'epic_workflow'),
+        ('GET', r'/api/v2/workflows', 'workflows'),
+        ('GET', r'/api/v2/projects/([0-9]+)/stories', 'project_stories'),
+        ('GET', r'/api/v2/(projects|epics|iterations)', 'list'),
+        ('GET', r'/api/v2/(stories|epics)/([0-9]+)', 'detail'),
+        ('POST', r'/api/v2/files', 'files'),
+        ('POST', r'/api/v2/stories/bulk', 'bulk'),
+        ('POST', r'/api/v2/(stories|epics)/([0-9]+)/(comments|tasks)', 'child'),
+        ('POST', r'/api/v2/(projects|epics|stories|iterations|story-links)', 'create'),
+        ('PUT', r'/api/v2/(.*)', 'update'),
+        ('DELETE', r'/api/v2/stories/bulk', 'delete_bulk'),
+        ('DELETE', r'/api/v2/(?:.*/)?([0-9]+)', 'delete'),
+    ]
+    epic_states = ["to do", "in progress", "done", "canceled", "proposed"]
+    story_states = ["Unscheduled", "Ready for Development", "In Development", "Ready for Review", "Completed", "Canceled"]
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.objects = {}  # id -> object (with its 'kind' and 'parent')
+        self.ids = iter(range(1, 10 ** 9))
+
+    def new(self, kind, content, parent=None):
+        with self.lock:
+            id = next(self.ids)
+            self.objects[id] = dict(content, id=id, kind=kind, parent=parent)
+        return self.objects[id]
+
+    def public(self, o):
+        return {k: v for k, v in o.items() if k not in ('kind', 'parent')}
+
+    # routes
+    def members(self, body, query):
+        return 200, [{"id": "00000000-bench", "profile": {"mention_name": "bench"}}]
+
+    def epic_workflow(self, body, query):
+        return 200, {"epic_states": [{"id": 500 + n, "name": s} for n, s in enumerate(self.epic_states)]}
+
+    def workflows(self, body, query):
+        return 200, [{"states": [{"id": 600 + n, "name": s} for n, s in enumerate(self.story_states)]}]
+
+    def list(self, body, query, kind):
+        return 200, [self.public(o) for o in list(self.objects.values()) if o["kind"] == kind]
+
+    def project_stories(self, body, query, project):
+        return 200, [self.public(o) for o in list(self.objects.values())
+                     if o["kind"] == "stories" and o.get("project_id") == int(project)]
+
+    def detail(self, body, query, kind, id):
+        o = self.objects.get(int(id))
+        if not o:
+            return 404, {"message": "Not found"}
+        children = [c for c in list(self.objects.values()) if c["parent"] == o["id"]]
+        return 200, dict(self.public(o), comments=[self.public(c) for c in children if c["kind"] == "comments"],
+                         tasks=[self.public(c) for c in children if c["kind"] == "tasks"])
+
+    def files(self, body, query):
+        count = body.count(b'filename="')
+        if count > 4:  # like Clubhouse, which only reads the fields file0 to file3
+            return 400, {"message": "At most 4 files per request"}
+        return 201, [self.public(self.new("files", {"name": "file"})) for _ in range(count)]
+
+    def create(self, body, query, kind):
+        return 201, self.public(self.new(kind, json.loads(body)))
+
+    def child(self, body, query, kind, id, child):
+        return 201, self.public(self.new(child, json.loads(body), parent=int(id)))
+
+    def bulk(self, body, query):
+        created = []
+        for story in json.loads(body)["stories"]:
+            s = self.new("stories", {k: v for k, v in story.items() if k not in ("comments", "tasks")})
+            created.append(dict(self.public(s),
+                                comments=[self.public(self.new("comments", c, s["id"])) for c in story.get("comments", [])],
+                                tasks=[self.public(self.new("tasks", t, s["id"])) for t in story.get("tasks", [])]))
+        return 201, created
+
+    def update(self, body, query, path):
+        o = self.objects.get(int(path.rsplit("/", 1)[-1]))
+        if o:
+            o.update(json.loads(body or b'{}'))
+        return 200, self.public(o) if o else {}
+
+    def delete_bulk(self, body, query):
+        for id in json.loads(body)["story_ids"]:
+            self.objects.pop(id, None)
+        return 204, b''
+
+    def delete(self, body, query, id):
+        self.objects.pop(int(id), None)
+        return 204, b''
@@ -0,0 +1,168 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def status_code(error):
+    """Returns the HTTP status code carried by an exception raised by the Jira or Clubhouse clients (or None)"""
+    code = getattr(error, 'status_code', None)
+    if code is None and getattr(error, 'response', None) is not None:
+        code = getattr(error.response, 'status_code', None)
+    return code
+
+
+def retry_after(error):
+    """Returns the delay (in seconds) requested by the server in the 'Retry-After' header of a 429 response (or None)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def parallel_map(function, items, workers=1):
+    """
+    Applies the function to every item, using at most 'workers' threads.
+    The results are returned in the same order as the items, as with the builtin map.
+    With a single worker, everything is executed in the calling thread.
+    The items run in a copy of the context of the caller (e.g. the project scope of the Resolver).
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(i) for i in items]
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(lambda i: context.copy().run(function, i), items))
+
+
+def isolated_map(function, items, workers=1, name=str):
+    """
+    Applies the function to every item concurrently, as parallel_map, but the failure of an item does not stop
+    the others: the errors are logged and returned. The progress is logged each time an item is finished.
+    :param name: gives the name of an item in the logs
+    :return: the results of the items that succeeded (item -> result), and the errors (item -> exception)
+    """
+    items = list(items)
+    results, errors = {}, {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items)))) as executor:
+        futures = {executor.submit(function, i): i for i in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+                logging.info("{} done".format(name(item)))
+            except Exception as e:
+                errors[item] = e
+                logging.error("{} failed: {!r}".format(name(item), e))
+            logging.info("Progress: {}/{} done, {} failed ({:.0f}s)".format(
+                len(results), len(items), len(errors), time.monotonic() - started))
+    return results, errors
+
+
+class TokenBucket:
+    """
+    Rate limiter: allows 'rate' calls per minute on average, with bursts of up to 'burst' calls
+    """
+    def __init__(self, rate, burst=None):
+        self.per_second = rate / 60.0
+        self.capacity = burst or max(1.0, self.per_second)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Waits until a call is allowed"""
+        while "No token available":
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.per_second)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.per_second
+            time.sleep(wait)
+
+
+class Throttle:
+    """
+    Bounds the number of concurrent calls to a remote API and backs off adaptively when the server
+    answers HTTP 429 (Too Many Requests): each 429 doubles the pause taken before every call,
+    each success halves it, so that the throughput converges towards what the server accepts.
+    Other statuses may be retried in the same way (e.g. 5xx errors), and the calls may be rate limited by a TokenBucket.
+    """
+    def __init__(self, workers=1, retries=5, max_delay=60.0, retry_statuses=(429,), bucket=None):
+        self.workers = workers
+        self.retries = retries
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+        self.bucket = bucket
+        self.delay = 0.0
+        self._slots = threading.BoundedSemaphore(workers)
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """Calls the function within a worker slot, and retries it as long as the server asks to slow down"""
+        attempt = 0
+        while "The server asks to slow down":
+            with self._slots:
+                if self.delay:
+                    time.sleep(self.delay)
+                if self.bucket:
+                    self.bucket.take()
+                try:
+                    result = function(*args, **kwargs)
+                except Exception as e:
+                    if status_code(e) not in self.retry_statuses or attempt >= self.retries:
+                        raise
+                    self._slow_down(retry_after(e))
+                else:
+                    self._speed_up()
+                    return result
+            attempt += 1
+            logging.debug("Slowed down by the server, retry #{} with delay {:.2f}s".format(attempt, self.delay))
+
+    def _slow_down(self, requested=None):
+        with self._lock:
+            self.delay = min(self.max_delay, max(requested or 0.0, self.delay * 2 or 1.0))
+
+    def _speed_up(self):
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > 0.05 else 0.0
+
+
+class ThrottledClient:
+    """
+    Wraps a REST client (e.g. the ClubhouseClient) so that all its calls go through a Throttle
+    :param hooks: hooks of the requests library added to every call (e.g. profiler.Profiler.response)
+    """
+    def __init__(self, client, throttle, hooks=None):
+        self.client = client
+        self.throttle = throttle
+        self.hooks = hooks
+
+    def get(self, *segments, **kwargs):
+        return self._call(self.client.get, segments, kwargs)
+
+    def post(self, *segments, **kwargs):
+        return self._call(self.client.post, segments, kwargs)
+
+    def put(self, *segments, **kwargs):
+        return self._call(self.client.put, segments, kwargs)
+
+    def delete(self, *segments, **kwargs):
+        return self._call(self.client.delete, segments, kwargs)
+
+    def _call(self, method, segments, kwargs):
+        if self.hooks:
+            kwargs = dict(kwargs, hooks=self.hooks)
+
+        def attempt():
+            for f in (kwargs.get('files') or {}).values():  # uploaded files must be sent again from the start
+                f[1].seek(0)
+            return method(*segments, **kwargs)
+        return self.throttle.call(attempt)
@@ -1,5 +1,7 @@
 import json
 
+_required = object()
+
 class Config:
     """This class provides an access to data in the configuration file
     as a class variable, i.e. similar so a global variable - without havin to pass the configuration dictionary to all methods"""
@@ -16,5 +18,8 @@ class Config:
             exit(1)
 
     @classmethod
-    def get(cls, parameter):
-        return cls.dict[parameter]
+    def get(cls, parameter, default=_required):
+        """Returns a parameter of the configuration; optional parameters must be given a default value"""
+        if default is _required:
+            return cls.dict[parameter]
+        return cls.dict.get(parameter, default)
@@ -0,0 +1,179 @@
+from attachment import Attachment
+from config import Config
+from jiratools import JiraTools
+from project import Sprint
+import json
+import logging
+import math
+import time
+
+
+class Estimate:
+    """
+    Projects the cost of migrating a project (option --estimate), without extracting it:
+    - the issues are counted with the JQL filters of the extraction (searches that return no issue)
+    - the comments, attachments, links, subtasks and watchers per story are measured on a sample page of stories
+    - the sprints are listed from the boards of the project, as the extraction does
+    The requests, the bytes and the duration of the migration are then projected from the counts, the options
+    (--scan, --bulk, workers) and the rate limit of Clubhouse; the latency of each server is measured on the way.
+    """
+    sample_size = 100  # number of stories in the sample page ('estimate' / 'sample_size' in the configuration)
+    epic_story_filters = ["'Epic Link' is not EMPTY"]  # all the issues found by the searches of the epics
+    sample_filters = ["issuetype != 'Epic'", "issuetype != 'Sub-task'"]
+
+    def __init__(self, jira_client, key, scan=False, bulk=False):
+        self.key = key
+        self.scan = scan
+        self.bulk = bulk
+        self.latency = []  # seconds taken by each Jira request of the estimate
+        self.epics = self._timed(JiraTools.count_issues, jira_client, key, JiraTools.epic_filters)
+        self.epic_stories = self._timed(JiraTools.count_issues, jira_client, key, self.epic_story_filters)
+        self.no_epic = self._timed(JiraTools.count_issues, jira_client, key, JiraTools.no_epic_filters)
+        self.subtasks = self._timed(JiraTools.count_issues, jira_client, key, JiraTools.subtask_filters)
+        self.sprints = len(JiraTools.get_project_sprints(jira_client, key)) if Sprint.enabled() else 0
+        self.sample(jira_client)
+
+    def _timed(self, function, *args, **kwargs):
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.latency.append(time.perf_counter() - started)
+        return result
+
+    @property
+    def stories(self):
+        return self.epic_stories + self.no_epic
+
+    @property
+    def issues(self):
+        return self.epics + self.stories + self.subtasks
+
+    def sample(self, jira_client):
+        """Measures the content of the stories on a page of the project, loaded as the extraction loads it"""
+        size = Config.get('estimate', {}).get('sample_size', self.sample_size)
+        jql = " and ".join(self.sample_filters + ["project = '{}'".format(self.key)])
+        page = self._timed(JiraTools.throttle.call, jira_client.search_issues, jql, startAt=0, maxResults=size,
+                           fields=JiraTools.fields(), expand=["watcher", "watches", "watchers"])
+        # the page size of the extraction: the size requested, within the limit accepted by the server for the sample
+        # (the limit is not known beyond the size of the sample: the number of searches may be overestimated)
+        requested = Config.get('jira', {}).get('page_size', JiraTools.page_size)
+        self.page_size = max(1, min(requested, page.maxResults))
+        link_types = Config.get('link_types', {})
+        n = max(len(page), 1)
+        self.per_story = {
+            "comments": sum(getattr(i.fields.comment, 'total', len(i.fields.comment.comments)) for i in page) / n,
+            "attachments": sum(len(i.fields.attachment) for i in page) / n,
+            "attachment_bytes": sum(a.size for i in page for a in i.fields.attachment) / n,
+            "links": sum(1 for i in page for l in i.fields.issuelinks
+                         if hasattr(l, 'outwardIssue') and link_types.get(l.type.name)) / n,
+            "with_subtasks": sum(1 for i in page if i.fields.subtasks) / n,
+            "watchers_fetched": sum(1 for i in page if self._fetches_watchers(i)) / n,
+            "jira_bytes": sum(len(json.dumps(i.raw)) for i in page) / n,
+            "text_bytes": sum(len(i.fields.summary or '') + len(i.fields.description or '')
+                              + sum(len(c.body or '') for c in i.fields.comment.comments) for i in page) / n,
+        }
+
+    @staticmethod
+    def _fetches_watchers(issue):
+        """Tells if the watchers of the issue need a separate request (see JiraTools.issue_watchers)"""
+        watches = getattr(issue.fields, 'watches', None)
+        count = getattr(watches, 'watchCount', None)
+        return count is None or count > len(getattr(watches, 'watchers', None) or [])
+
+    def pages(self, count):
+        return max(1, math.ceil(count / self.page_size))
+
+    def jira_requests(self):
+        """Number of Jira requests, by kind"""
+        p = self.per_story
+        if self.scan:
+            searches = 1 + self.pages(self.issues)
+        else:
+            searches = (1 + self.pages(self.epics) + self.epics + self.epic_stories // self.page_size
+                        + self.pages(self.no_epic) + round(self.stories * p["with_subtasks"]))
+        return {
+            "searches": searches,
+            "watchers": round(self.issues * p["watchers_fetched"]),  # the subtasks have watchers too
+            "sprints": 2 + self.sprints // 50 if self.sprints else 0,
+            "attachments": round(self.stories * p["attachments"]),
+        }
+
+    def clubhouse_requests(self):
+        """Number of Clubhouse requests, by kind (the deletion of a previous attempt is not counted)"""
+        p = self.per_story
+        comments = round((self.stories + self.epics) * p["comments"])
+        if self.bulk:
+            stories = math.ceil(self.stories / Config.get('clubhouse', {}).get('batch_size', 50))
+            comments = round(self.epics * p["comments"])
+            tasks = 0
+        else:
+            stories, tasks = self.stories, self.subtasks
+        return {
+            "project": 3,  # list the projects and the epics, create the project
+            "files": math.ceil(self.stories * p["attachments"] / Attachment.batch_size()),
+            "iterations": 1 + self.sprints if self.sprints else 0,
+            "epics": self.epics,
+            "stories": stories,
+            "comments": comments,
+            "tasks": tasks,
+            "links": round(self.stories * p["links"]),
+        }
+
+    def bytes(self):
+        """Bytes received from Jira and sent to Clubhouse"""
+        p = self.per_story
+        attachments = self.stories * p["attachment_bytes"]
+        return {
+            "jira": round(self.issues * p["jira_bytes"] + attachments),
+            "clubhouse": round((self.stories + self.epics) * p["text_bytes"] + attachments),
+        }
+
+    @classmethod
+    def clubhouse_latency(cls, clubhouse):
+        """Seconds taken by a request to Clubhouse"""
+        started = time.perf_counter()
+        clubhouse.get('projects')
+        return time.perf_counter() - started
+
+    def duration(self, clubhouse_latency, clubhouse_workers=1):
+        """
+        Seconds taken by the migration of the project: the Jira requests are shared by the Jira workers
+        (the attachments by the attachment workers), the Clubhouse requests by the Clubhouse workers, within
+        the rate limit. The phases are assumed to run one after the other, and the transfer time is not included.
+        """
+        jira_latency = sum(self.latency) / len(self.latency)
+        jira = self.jira_requests()
+        attachment_workers = Config.get('attachments', {}).get('workers', 4)
+        requests = sum(self.clubhouse_requests().values())
+        rate = Config.get('clubhouse', {}).get('rate_limit', 200) / 60
+        return {
+            "extract": (jira["searches"] + jira["watchers"] + jira["sprints"]) * jira_latency / JiraTools.workers(),
+            "download": jira["attachments"] * jira_latency / attachment_workers,
+            "save": max(requests * clubhouse_latency / clubhouse_workers, requests / rate),
+        }
+
+    @classmethod
+    def report(cls, estimates, clubhouse_latency, clubhouse_workers=1):
+        """Returns a human readable report of the estimates, one line per project and a total"""
+        lines = ["{:<12}{:>9}{:>9}{:>13}{:>13}{:>10}{:>10}{:>12}".format(
+            "project", "issues", "files", "jira req.", "clubhouse", "MB in", "MB out", "duration")]
+        totals = [0] * 7
+        for e in estimates:
+            row = [e.issues, round(e.stories * e.per_story["attachments"]), sum(e.jira_requests().values()),
+                   sum(e.clubhouse_requests().values()), e.bytes()["jira"] / 2 ** 20,
+                   e.bytes()["clubhouse"] / 2 ** 20, sum(e.duration(clubhouse_latency, clubhouse_workers).values())]
+            totals = [t + v for t, v in zip(totals, row)]
+            lines.append(cls._line(e.key, row))
+        lines.append(cls._line("total", totals))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _line(name, row):
+        issues, files, jira, clubhouse, received, sent, seconds = row
+        return "{:<12}{:>9}{:>9}{:>13}{:>13}{:>10.1f}{:>10.1f}{:>12}".format(
+            name, issues, files, jira, clubhouse, received, sent,
+            "{}:{:02}:{:02}".format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60)))
+
+    def log(self):
+        logging.info("Project '{}': {} epics, {} stories, {} subtasks, {} sprints; per story: {}".format(
+            self.key, self.epics, self.stories, self.subtasks, self.sprints,
+            ", ".join("{} {:.1f}".format(k, v) for k, v in self.per_story.items())))
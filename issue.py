@@ -1,9 +1,13 @@
+from concurrency import parallel_map
 from config import Config
 from jiratools import JiraTools
 from link import Link
-import os
-from registry import Members, StoryStates, EpicStates
-import re
+from attachment import Attachment
+from journal import Journal
+from profiler import Profiler
+from resolver import Resolver
+import hashlib
+import json
 import logging
 
 # ----------------------------------------
@@ -12,37 +16,52 @@ import logging
 class Issue:
     """
     Generic class for stories and epics
+    Only the values needed to create the Clubhouse objects are kept (in slots): the Jira resource
+    and the Jira client are not referenced, so that they can be freed as soon as the issue is built
     """
     urlbase = None
+    immutable = ('created_at', 'updated_at', 'external_id', 'comments', 'tasks')  # fields not accepted by an update
+    __slots__ = ('epic', '_project', 'key', 'issuetype', 'name', 'created', 'updated', 'external_id', 'deadline',
+                 'description', 'owners', 'requester', 'comments', 'components', 'followers', 'attachments',
+                 'subtasks', 'links', 'sprints')
 
     def __init__(self, jira_client, jira_issue):
-        self.jira_client = jira_client
         self.epic = None
         self._project = None
-        self.source = jira_issue
-        self.target = None
-        fields = self.source.fields
+        self.key = jira_issue.key
+        fields = jira_issue.fields
+        self.issuetype = fields.issuetype.name
         self.name = fields.summary
         self.created = fields.created
         self.updated = fields.updated
-        self.external_id = "JIRA_{}".format(self.source.key)
+        self.external_id = "JIRA_{}".format(self.key)
         self.deadline = fields.duedate
         self.description = fields.description
-        self.owners = [Config.get('users').get(fields.assignee.key)] if fields.assignee else None
-        self.requester = Config.get('users').get(fields.reporter.key)
-        self.comments = [Comment(self, c.id, Config.get('users').get(c.author.key), c.created, c.body)
+        # the users are stored as Clubhouse member ids
+        self.owners = [Resolver.user(fields.assignee.key)] if fields.assignee else None
+        self.requester = Resolver.user(fields.reporter.key)
+        self.comments = [Comment(self, c.id, Resolver.user(c.author.key), c.created, c.body)
                          for c in fields.comment.comments]
-        self.components = fields.components
-        self.followers = [Config.get('users').get(u.name) for u in JiraTools.issue_watchers(jira_client, self.source)]
+        self.components = tuple(c.name for c in fields.components)
+        self.followers = [Resolver.user(u.name) for u in JiraTools.issue_watchers(jira_client, jira_issue)]
         self.attachments = [Attachment(a) for a in fields.attachment]
         self.subtasks = None
         self.links = []
-        self.sprints = [re.search("id=([0-9]+),", sprint).group(1) for sprint in fields.customfield_10115] if fields.customfield_10115 else []
+        self.sprints = [JiraTools.sprint_id(sprint) for sprint in fields.customfield_10115 or []]
         for link in fields.issuelinks:
-            target_type = Config.get("link_types").get(link.type.name)
+            target_type = Resolver.resolve("link_types", link.type.name)
             if hasattr(link, 'outwardIssue') and target_type:  # keep only types that exist in the mapping
                 self.links.append(Link(self, link.outwardIssue.key, target_type))
 
+    @property
+    def target(self):
+        """Clubhouse id of the issue (None until it is created), kept in the journal"""
+        return Journal.get(self.urlbase, self.external_id)
+
+    @target.setter
+    def target(self, id):
+        Journal.record(self.urlbase, self.external_id, id)
+
     @property
     def project(self):
         return self._project
@@ -53,19 +72,20 @@ class Issue:
         project.add_to_sprints(self, self.sprints) # when project is defined, then add issue to project sprints
 
     def __str__(self):
-        return "<{} {} '{}'>".format(type(self).__name__, self.source.key, self.name)
+        return "<{} {} '{}'>".format(type(self).__name__, self.key, self.name)
 
     def __repr__(self):
         return self.__str__()
 
-    def json(self):
+    def json(self, inline=False):
         """
         Construct the common json for the creattion of all subclasses of issues
+        :param inline: if True, the comments are included in the json (instead of being saved afterwards)
         :return: json (thatt he  caller must complete for the specific class of issues)
         """
         json = {
             "name": self.name,
-            "requested_by_id": Members.get_id(self.requester),
+            "requested_by_id": self.requester,
             "created_at": self.created,
             "updated_at": self.updated,
             "external_id": self.external_id, #"JIRA: {}".format(self.source.key)
@@ -73,9 +93,9 @@ class Issue:
 
         if self.deadline: json["deadline"] = self.deadline
         if self.description: json["description"] = self.description
-        if self.owners: json["owner_ids"] = [Members.get_id(o) for o in self.owners]
-        if self.followers: json["follower_ids"] = [Members.get_id(f) for f in self.followers]
-        #if self.comments: json["comments"] = [c.json() for c in self.comments]
+        if self.owners: json["owner_ids"] = self.owners
+        if self.followers: json["follower_ids"] = self.followers
+        if inline and self.comments: json["comments"] = [c.json() for c in self.comments]
         sprint_labels = [{"name": "Sprint: {}".format(s.name)} for s in self.sprints]
         if sprint_labels:
             json["labels"] = sprint_labels
@@ -84,12 +104,70 @@ class Issue:
     def save(self, clubhouse):
         """
         Common method to create all kinds of issues in clubhouse
+        (the objects already created by a previous run are skipped, see journal.Journal)
         """
         # 1. Create the object
-        json = self.json()
-        response = clubhouse.post(self.urlbase, json=json)
-        self.target = response["id"]
-        [c.save(clubhouse) for c in self.comments]
+        self.create(clubhouse)
+        # 2. Add the comments
+        [c.save(clubhouse) for c in self.comments if not c.target]
+
+    @Profiler.timed("Issue.create")
+    def create(self, clubhouse):
+        """Creates the object itself, without its comments (unless it was already created by a previous run)"""
+        if not self.target:
+            json = self.json()
+            response = clubhouse.post(self.urlbase, json=json)
+            self.target = response["id"]
+
+    def digest(self):
+        """Hash of the payload of the issue (with its comments, subtasks and links), to detect changes between runs"""
+        content = [self.json(inline=True), sorted(l.key for l in self.links)]
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    def record_digest(self):
+        Journal.record('hashes', self.external_id, self.digest())
+
+    def forget(self):
+        """Forgets the ids of the issue and of its comments and subtasks (they no longer exist in Clubhouse)"""
+        for o in [self] + self.comments + (self.subtasks or []):
+            if o.target:
+                o.target = None
+
+    def sync(self, clubhouse, existing, **options):
+        """
+        Brings the object up to date in Clubhouse (see Project.sync): creates it if it does not exist,
+        updates it (and its comments) if its payload has changed since the previous run
+        :param existing: the object with the same external id in Clubhouse, or None
+        :param options: passed to save() when the object is created
+        :return: 'created', 'updated' or 'unchanged'
+        """
+        if not existing:
+            self.forget()
+            self.save(clubhouse, **options)
+            return 'created'
+        if self.target != existing['id']:
+            self.target = existing['id']
+        if Journal.get('hashes', self.external_id) == self.digest():
+            return 'unchanged'
+        clubhouse.put(self.urlbase, self.target, json={k: v for k, v in self.json().items() if k not in self.immutable})
+        self.sync_content(clubhouse, clubhouse.get(self.urlbase, self.target))
+        self.record_digest()
+        return 'updated'
+
+    def sync_content(self, clubhouse, detail):
+        """Creates, updates or deletes the comments so that they match Jira, by external id"""
+        remote = {c['external_id']: c for c in detail.get('comments', []) if c.get('external_id')}
+        for c in self.comments:
+            r = remote.pop(c.key, None)
+            if not r:
+                c.save(clubhouse)
+                continue
+            if c.target != r['id']:
+                c.target = r['id']
+            if r.get('text') != c.comment:
+                clubhouse.put(self.urlbase, self.target, 'comments', c.target, json={"text": c.comment})
+        for r in remote.values():
+            clubhouse.delete(self.urlbase, self.target, 'comments', r['id'])
 
 
 # ----------------------------------------
@@ -97,6 +175,8 @@ class Issue:
 # ----------------------------------------
 class Comment:
     """ Class for storing comments on an issue"""
+    __slots__ = ('issue', 'key', 'author', 'date', 'comment')
+
     def __init__(self, issue, key, author, date, comment):
         self.issue = issue
         self.key = key
@@ -104,14 +184,23 @@ class Comment:
         self.date = date
         self.comment = comment
 
+    @property
+    def target(self):
+        return Journal.get('comments', "{}/{}".format(self.issue.external_id, self.key))
+
+    @target.setter
+    def target(self, id):
+        Journal.record('comments', "{}/{}".format(self.issue.external_id, self.key), id)
+
     def json(self):
         return {
-            "author_id": Members.get_id(self.author),
+            "author_id": self.author,
             "created_at": self.date,
             "external_id": self.key,
             "text": self.comment
         }
 
+    @Profiler.timed("Comment.save")
     def save(self, clubhouse):
         """ Method to save a comment. May be used instead of including the jons in the item creation itself"""
         response = clubhouse.post(self.issue.urlbase, self.issue.target, 'comments', json=self.json())
@@ -125,11 +214,16 @@ class Epic(Issue):
     Class to represent Epics
     """
     urlbase = 'epics'
+    __slots__ = ('status', 'stories')
 
-    def __init__(self, jira_client, jira_epic):
+    def __init__(self, jira_client, jira_epic, finder=JiraTools):
+        """
+        :param finder: where to look for the stories of the epic: JiraTools (Jira searches) or a jiratools.ProjectScan
+        """
         super().__init__(jira_client, jira_epic)
-        self.status = Config.get('epic_states').get(self.source.fields.status.name)
-        self.stories = [Story(jira_client, s) for s in JiraTools.get_epic_issues(jira_client, epic=self.source.key)]
+        self.status = Resolver.resolve('epic_states', jira_epic.fields.status.name)  # Clubhouse state id
+        self.stories = parallel_map(lambda s: Story(jira_client, s, finder),
+                                    finder.get_epic_issues(jira_client, epic=self.key), JiraTools.workers())
         for s in self.stories:
             s.epic = self
 
@@ -139,26 +233,23 @@ class Epic(Issue):
         for s in self.stories:
             s.project = project
 
-    def json(self):
+    def json(self, inline=False):
         """ Return the json to create the item in Clubhouse """
-        json = super().json() # default json
-        json["epic_state_id"] = EpicStates.get_id(self.status)
+        json = super().json(inline) # default json
+        json["epic_state_id"] = self.status
         return json
 
-    def save(self, clubhouse):
+    def save(self, clubhouse, with_stories=True):
         logging.info("Saving epic '{}'".format(self.name))
-        self.delete(clubhouse)
         super().save(clubhouse)
-        for s in self.stories:
-            s.save(clubhouse)
+        self.record_digest()
+        if with_stories:
+            for s in self.stories:
+                s.save(clubhouse)
 
-    def delete(self, clubhouse):
-        # Should search by external id, but it does not work
-        epics = clubhouse.get("search", self.urlbase, json={"query": "name={}".format(self.name)})
-        if epics and epics["total"] > 0:
-                [clubhouse.delete(self.urlbase, e["id"])
-                 for e in epics["data"]
-                 if e["external_id"] == self.external_id]
+    def sync(self, clubhouse, existing):
+        """See Issue.sync; the stories are synchronized separately (see Project.sync)"""
+        return super().sync(clubhouse, existing, with_stories=False)
 
 # ----------------------------------------
 # class Story
@@ -168,52 +259,137 @@ class Story(Issue):
     Class to represent stories (= Jira issues except epics)
     """
     urlbase = 'stories'
+    __slots__ = ('story_type', 'status')
 
-    def __init__(self, jira_client, jira_issue):
+    def __init__(self, jira_client, jira_issue, finder=JiraTools):
+        """
+        :param finder: where to look for the subtasks of the story: JiraTools (Jira searches) or a jiratools.ProjectScan
+        """
         super().__init__(jira_client, jira_issue)
-        self.story_type = Config.get('story_types').get(self.source.fields.issuetype.name)
-        self.status = Config.get('issue_states').get(self.source.fields.status.name)
+        self.story_type = Resolver.resolve('story_types', self.issuetype)
+        self.status = Resolver.resolve('issue_states', jira_issue.fields.status.name)  # Clubhouse state id
         self.subtasks = []
         if jira_issue.fields.subtasks:
-            self.subtasks = [Subtask(jira_client, s) for s in JiraTools.get_subtasks(jira_client, jira_issue.key)]
+            self.subtasks = parallel_map(lambda s: Subtask(jira_client, s),
+                                         finder.get_subtasks(jira_client, jira_issue.key), JiraTools.workers())
             for s in self.subtasks:
                 s.parent = self
 
-    def json(self):
-        """ Return the json to create the item in Clubhouse """
-        json = super().json() # default json for all issues
-        json["workflow_state_id"] = StoryStates.get_id(self.status)
+    def json(self, inline=False):
+        """
+        Return the json to create the item in Clubhouse
+        :param inline: if True, the comments and the subtasks are included in the json (see save_bulk)
+        """
+        json = super().json(inline) # default json for all issues
+        json["workflow_state_id"] = self.status
         json["story_type"] = self.story_type
         if self.epic:
             json["epic_id"] = self.epic.target
         if self.project:
             json["project_id"] = self.project.target
+        iterations = [s.target for s in self.sprints if s.target]
+        if iterations:  # a story belongs to one iteration only: the last sprint of the issue
+            json["iteration_id"] = iterations[-1]
         if self.attachments:  # attachments must be uploaded beforehand
             json["file_ids"] = [a.target for a in self.attachments]
+        if inline and self.subtasks:
+            json["tasks"] = [s.json() for s in self.subtasks]
         return json
 
     def save(self, clubhouse):
         logging.info("Saving story '{}'".format(self.name))
         if self.story_type:
-            # 0. Upload the files (so that they have an id)
-            [a.save(clubhouse) for a in self.attachments]
-            # 1. Create the object
+            # 1. Create the object (and its comments)
             super().save(clubhouse)
             # 2. Add subtasks
             if self.subtasks:
-                [s.save(clubhouse) for s in self.subtasks]
+                [s.save(clubhouse) for s in self.subtasks if not s.target]
+            self.record_digest()
         else: # null type
-            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.source.fields.issuetype.name))
+            logging.warning("--> Story '{}' of unknown type '{}' was not saved".format(self.name, self.issuetype))
+
+    def create(self, clubhouse):
+        # 0. Upload the files (so that they have an id), unless they have already been uploaded by Project.save
+        [a.save(clubhouse) for a in self.attachments if not a.target]
+        super().create(clubhouse)
+
+    @classmethod
+    def save_bulk(cls, clubhouse, stories):
+        """
+        Creates the stories in batches ('clubhouse' / 'batch_size' in the configuration, default 50),
+        with their comments and subtasks included in the story json: one request per batch instead of
+        one request per story, comment and subtask.
+        The stories already created by a previous run, and those of unknown type, go through the usual save
+        """
+        new = []
+        for s in stories:
+            if s.story_type and not s.target:
+                new.append(s)
+            else:
+                s.save(clubhouse)
+        for i, batch in enumerate(cls.batches(new)):
+            logging.info("Saving stories: batch {}".format(i + 1))
+            cls.create_bulk(clubhouse, batch)
+
+    @classmethod
+    def batches(cls, stories):
+        """Splits a list of stories in batches for create_bulk ('clubhouse' / 'batch_size', default 50)"""
+        batch_size = Config.get('clubhouse', {}).get('batch_size', 50)
+        return [stories[i:i + batch_size] for i in range(0, len(stories), batch_size)]
+
+    @classmethod
+    def create_bulk(cls, clubhouse, batch):
+        """Creates a batch of stories, with their comments and subtasks, in a single request"""
+        [a.save(clubhouse) for s in batch for a in s.attachments if not a.target]
+        with Profiler.measure("Story.create_bulk", items=len(batch)):
+            response = clubhouse.post(cls.urlbase, 'bulk', json={"stories": [s.json(inline=True) for s in batch]})
+        created = {r["external_id"]: r for r in response}
+        for s in batch:
+            s.set_targets(created[s.external_id])
+
+    def set_targets(self, created):
+        """Records the ids of a story created in bulk, and of its comments and subtasks"""
+        self.target = created["id"]
+        comments = {c.get("external_id"): c["id"] for c in created.get("comments", [])}
+        for c in self.comments:
+            c.target = comments.get(c.key)
+        tasks = {t.get("external_id"): t["id"] for t in created.get("tasks", [])}
+        for s in self.subtasks:
+            s.target = tasks.get(s.key)
+        self.record_digest()
+
+    def sync(self, clubhouse, existing):
+        if not self.story_type:
+            return 'skipped'
+        return super().sync(clubhouse, existing)
+
+    def sync_content(self, clubhouse, detail):
+        """Synchronizes the comments, then the subtasks, by external id"""
+        super().sync_content(clubhouse, detail)
+        remote = {t['external_id']: t for t in detail.get('tasks', []) if t.get('external_id')}
+        for s in self.subtasks:
+            r = remote.pop(s.key, None)
+            if not r:
+                s.save(clubhouse)
+                continue
+            if s.target != r['id']:
+                s.target = r['id']
+            json = {"description": s.description, "complete": s.status}
+            if any(r.get(k) != v for k, v in json.items()):
+                clubhouse.put(self.urlbase, self.target, s.urlbase, s.target, json=json)
+        for r in remote.values():
+            clubhouse.delete(self.urlbase, self.target, Subtask.urlbase, r['id'])
 
 # ----------------------------------------
 # class Subtask
 # ----------------------------------------
 class Subtask(Issue):
     urlbase = 'tasks'
+    __slots__ = ('status', 'parent')
 
     def __init__(self, jira_client, jira_issue):
         super().__init__(jira_client, jira_issue)
-        self.status = Config.get("subtask_states").get(self.source.fields.status.name)
+        self.status = Resolver.resolve("subtask_states", jira_issue.fields.status.name)
         self.description = self.name
         self.parent = None
 
@@ -223,44 +399,15 @@ class Subtask(Issue):
             "complete": self.status,
             "created_at": self.created,
             "description": self.description,
-            "external_id": self.source.key,
+            "external_id": self.key,
             "updated_at": self.updated
         }
         #if self.owners:
         #    json["owner_ids"] = [o.public_id for o in self.owners]
         return json
 
+    @Profiler.timed("Subtask.save")
     def save(self, clubhouse):
         """ Method to save a comment. May be used instead of including the jons in the item creation itself"""
         response = clubhouse.post(self.parent.urlbase, self.parent.target, self.urlbase, json=self.json())
         self.target = response["id"]
-
-# ----------------------------------------
-# class Attachment
-# ----------------------------------------
-class Attachment:
-    def __init__(self, jira_attachment):
-        self.source = jira_attachment
-        self.target = None
-        self.filename = jira_attachment.filename
-        self.author = Config.get('users').get(jira_attachment.author.name)
-        self.created = jira_attachment.created
-        self.size = jira_attachment.size
-        self.mimeType = jira_attachment.mimeType
-        self.url = jira_attachment.content
-        folder = Config.get("attachments").get('folder')
-        self.localfile = "{}/{}".format(folder, self.filename)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        with open(self.localfile, 'wb') as f:
-            f.write(jira_attachment.get())
-            f.close()
-
-    def save(self, clubhouse):
-        """
-        Upload a file to the server
-        """
-        files = {"file": (self.filename, open(self.localfile, 'rb'), self.mimeType)}
-        response = clubhouse.post('files', files=files)
-        self.target = response[0]["id"]
-        return self.target
@@ -1,34 +1,179 @@
 import argparse
+import atexit
 from jira import JIRA  # https://jira.readthedocs.io
-from clubhouse import ClubhouseClient
+from attachment import Attachment
+from concurrency import Throttle, ThrottledClient, TokenBucket, isolated_map
+from payloads import Exporter, Loader
 from project import Project
+from snapshot import Snapshot
+from transport import CachedClient, SessionClient, pool
 from config import Config
+from estimate import Estimate
+from jiratools import JiraTools
+from journal import Journal
+from link import Link
 import logging
-from registry import Members, EpicStates, StoryStates
+from profiler import Profiler
+from registry import Members, EpicStates, Registry, StoryStates
+from resolver import Resolver
 
 ## Parse command line
 parser = argparse.ArgumentParser()
 parser.add_argument('--config', '-c', required=True)  # Config
 parser.add_argument('--log', default=logging.INFO) # log level
-parser.add_argument('--jira_server', '-j', required=True) # log level
-parser.add_argument('--jira_user', '-u', required=True) # log level
-parser.add_argument('--jira_token', '-t', required=True) # log level
+parser.add_argument('--jira_server', '-j') # log level
+parser.add_argument('--jira_user', '-u') # log level
+parser.add_argument('--jira_token', '-t') # log level
 parser.add_argument('--clubhouse_token', '-k', required=True) # log level
 parser.add_argument('--project', '-p', nargs='+')
+parser.add_argument('--jira_workers', type=int, default=1) # number of concurrent calls to Jira during the extraction
+parser.add_argument('--scan', action='store_true') # load each project with a single paged search
+parser.add_argument('--snapshot') # local file where the Jira data is kept between runs (implies --scan)
+parser.add_argument('--journal') # file where the ids of the created objects are recorded
+parser.add_argument('--resume', action='store_true') # resume an interrupted migration from the journal
+parser.add_argument('--bulk', action='store_true') # create the stories in batches, with their comments and tasks
+parser.add_argument('--clubhouse_workers', type=int, default=1) # number of concurrent writes to Clubhouse
+parser.add_argument('--stream', action='store_true') # write each epic to Clubhouse while the next ones are extracted
+parser.add_argument('--queue_size', type=int, default=10) # number of epics (or batches of stories) waiting to be written
+parser.add_argument('--parallel_projects', type=int, default=1) # number of projects migrated at the same time
+parser.add_argument('--sync', action='store_true') # update a previous migration instead of recreating it
+parser.add_argument('--export') # write the Clubhouse payloads to a file instead of sending them
+parser.add_argument('--load') # send the payloads of a file written by --export to Clubhouse (Jira is not used)
+parser.add_argument('--estimate', action='store_true') # project the requests, bytes and duration of the migration, without migrating
+parser.add_argument('--profile') # file where the metrics of the run are written (time per phase, calls per endpoint)
 args = parser.parse_args()
+if not args.load and not (args.jira_server and args.jira_user and args.jira_token and args.project):
+    parser.error("--jira_server, --jira_user, --jira_token and --project are required (unless --load is used)")
+if args.export and (args.stream or args.journal):
+    parser.error("--export cannot be used with --stream or --journal")
+if (args.resume or args.sync) and not args.journal:
+    parser.error("--resume and --sync require a --journal")
+if args.sync and (args.stream or args.export):
+    parser.error("--sync cannot be used with --stream or --export")
+if args.estimate and (args.load or args.export or args.sync):
+    parser.error("--estimate cannot be used with --load, --export or --sync")
+if args.parallel_projects > 1 and (args.stream or args.export):
+    parser.error("--parallel_projects cannot be used with --stream or --export")
 logging.basicConfig(level=args.log)
 
 ## Load the configuration file
 Config.load(args.config)
 
+## Open the journal of created objects
+if args.journal:
+    Journal.open(args.journal, resume=args.resume or args.sync)
+
+## Profile the run: the metrics are written when the script ends, even on error
+if args.profile:
+    Profiler.enable()
+
+    def write_profile():
+        Profiler.save(args.profile)
+        print(Profiler.summary())
+    atexit.register(write_profile)
+
 ## Connect and initialize
+# the connections to Jira and Clubhouse are pooled and kept alive, one per worker (see transport.pool)
+# all the calls to Clubhouse are rate limited, and retried on 429 and 5xx errors; their GETs are cached for a few seconds
+attachment_workers = Config.get('attachments', {}).get('workers', 4)
+clubhouse_client = CachedClient(
+    ThrottledClient(SessionClient(args.clubhouse_token, max(args.clubhouse_workers, attachment_workers)),
+                    Throttle(args.clubhouse_workers, retry_statuses=(429, 500, 502, 503, 504),
+                             bucket=TokenBucket(Config.get('clubhouse', {}).get('rate_limit', 200))),
+                    hooks={'response': Profiler.response} if args.profile else None),
+    ttl=Config.get('clubhouse', {}).get('cache_ttl', 30))
+Attachment.set_workspace(args.clubhouse_token)  # the uploaded files are reused within the same workspace only
+Registry.set_workspace(args.clubhouse_token)  # so are the cached members and workflows
+
+## Replay a file of payloads
+if args.load:
+    with Profiler.phase("load"):
+        Loader(clubhouse_client).load(args.load)
+    exit(0)
+
+with Profiler.phase("registries"):
+    Members.init(clubhouse_client)
+    StoryStates.init(clubhouse_client)
+    EpicStates.init(clubhouse_client)
 jira_client = JIRA(args.jira_server, basic_auth=(args.jira_user, args.jira_token))
-clubhouse_client = ClubhouseClient(args.clubhouse_token)
-Members.init(clubhouse_client)
-StoryStates.init(clubhouse_client)
-EpicStates.init(clubhouse_client)
+pool(jira_client._session, max(args.jira_workers, attachment_workers))
+if args.profile:
+    Profiler.hook(jira_client._session)
+JiraTools.set_workers(args.jira_workers)
+if args.snapshot:
+    JiraTools.snapshot = Snapshot(args.snapshot)
+Resolver.compile()
+exporter = Exporter(args.export) if args.export else None
+
+## Estimate the cost of the migration: the projects are counted and sampled, not extracted
+if args.estimate:
+    with Profiler.phase("estimate"):
+        estimates = [Estimate(jira_client, key, scan=args.scan, bulk=args.bulk) for key in args.project]
+    for estimate in estimates:
+        estimate.log()
+    print(Estimate.report(estimates, Estimate.clubhouse_latency(clubhouse_client), args.clubhouse_workers))
+    exit(0)
+
+## Migrate several projects at the same time
+# The registries and the resolver are only read from now on. The Jira and Clubhouse throttles are shared by all
+# the projects: --jira_workers and --clubhouse_workers (and the rate limit) are global budgets.
+# All the projects are loaded before anything is written; a project that fails, or whose mapping is incomplete,
+# does not stop the others.
+if args.parallel_projects > 1:
+    with Profiler.phase("extract"):
+        loaded, failed = isolated_map(lambda key: Project(jira_client, key, scan=args.scan), args.project,
+                                      args.parallel_projects, name="Loading project '{}'".format)
+    JiraTools.log_watcher_stats()
+
+    def migrate(project):
+        if not Resolver.check(project.key):  # nothing is written for a project whose mapping is incomplete
+            raise ValueError("Incomplete mapping in project '{}'".format(project.key))
+        project.download_attachments(jira_client)
+        if args.sync:
+            project.sync(clubhouse_client, workers=args.clubhouse_workers)
+        else:
+            project.save(clubhouse_client, bulk=args.bulk, workers=args.clubhouse_workers)
+
+    with Profiler.phase("migrate"):  # the downloads and the writes of the projects overlap
+        migrated, errors = isolated_map(migrate, [loaded[key] for key in args.project if key in loaded],
+                                        args.parallel_projects, name="Migrating {}".format)
+    failed.update((p.key, e) for p, e in errors.items())
+    with Profiler.phase("links"):
+        Link.save_all(clubhouse_client, [l for p in migrated for l in p.links()], args.clubhouse_workers)
+    for key in args.project:
+        logging.info("Project '{}': {}".format(key, "FAILED" if key in failed else "migrated"))
+    exit(1 if failed else 0)
 
 ## Load and Save each project
+links = []  # the links are saved at the end, when the stories of all the projects exist
 for key in args.project:
+    if args.stream:
+        logging.info("Stream project '{}'".format(key))
+        project = Project(jira_client, key, extract=False)
+        with Profiler.phase("stream"):  # the extraction and the writes overlap
+            project.stream(jira_client, clubhouse_client, scan=args.scan, bulk=args.bulk, queue_size=args.queue_size)
+        JiraTools.log_watcher_stats()
+        links += project.links()
+        continue
     logging.info("Load project '{}'".format(key))
-    Project(jira_client, key).save(clubhouse_client)
+    with Profiler.phase("extract"):
+        project = Project(jira_client, key, scan=args.scan)
+    JiraTools.log_watcher_stats()
+    if not Resolver.check():  # stop before writing anything if the mapping is incomplete
+        exit(1)
+    with Profiler.phase("download"):
+        project.download_attachments(jira_client)
+    with Profiler.phase("save"):
+        if exporter:
+            exporter.export(project, bulk=args.bulk)
+        elif args.sync:
+            project.sync(clubhouse_client, workers=args.clubhouse_workers)
+        else:
+            project.save(clubhouse_client, bulk=args.bulk, workers=args.clubhouse_workers)
+    links += project.links()
+with Profiler.phase("links"):
+    if exporter:
+        Link.save_all(exporter, links)
+        exporter.close()
+    else:
+        Link.save_all(clubhouse_client, links, args.clubhouse_workers)
@@ -1,17 +1,56 @@
+import logging
+import re
+import threading
+from collections import defaultdict
+from concurrency import Throttle, parallel_map
+from config import Config
+from jira.resources import Sprint
+from profiler import Profiler
+
+
 class JiraTools:
+    throttle = Throttle()  # bounds the number of concurrent calls to Jira (see set_workers)
+    watcher_stats = {"inline": 0, "snapshot": 0, "fetched": 0}  # how the watchers were resolved, run totals
+    _stats_lock = threading.Lock()
+    snapshot = None  # optional snapshot.Snapshot where watchers and sprints are cached across runs
     jira_fields = ["assignee", "comment", "components",
                    "customfield_10005", "customfield_10115",
                    "created", "description",
-                   "issuelinks", "issuetype",
+                   "issuelinks", "issuetype", "parent",
                    "reporter", "status",
                    "subtasks", "summary", "attachment",
-                   "updated", "duedate", "watches"]
+                   "updated", "duedate", "watches"]  # default list of fields, may be redefined in the configuration
+    page_size = 1000  # default page size requested; Jira answers with the largest size it accepts
+    # JQL filters of the searches of the extraction (also used by estimate.Estimate to count the issues)
+    epic_filters = ["issuetype = 'Epic'"]
+    no_epic_filters = ["'Epic Link' is EMPTY", "issuetype != 'Epic'", "issuetype != 'Sub-task'"]
+    subtask_filters = ["issuetype = 'Sub-task'"]
+    # Jira Software REST API (the client defaults to the older GreenHopper API, which has no board listing)
+    agile_base = '{server}/rest/agile/1.0/{path}'
+
+    @classmethod
+    def set_workers(cls, workers):
+        """Sets the number of Jira calls that may run concurrently during the extraction"""
+        cls.throttle = Throttle(workers)
+
+    @classmethod
+    def workers(cls):
+        return cls.throttle.workers
+
+    @classmethod
+    def fields(cls):
+        """Returns the list of fields loaded for each issue (configuration parameter 'jira' / 'fields')"""
+        return Config.get('jira', {}).get('fields', cls.jira_fields)
+
+    @classmethod
+    def get_project(cls, jira, key):
+        return cls.throttle.call(jira.project, key)
 
     @classmethod
     def get_project_epics(cls, jira, project):
         """Returns the list of epics in a jira project"""
         #type_filter += "and issuetype not in ('{}')".format("','".join(excluded_types)) if excluded_types else ''
-        return cls.get_issue_list(jira, project, ["issuetype = 'Epic'"])
+        return cls.get_issue_list(jira, project, cls.epic_filters)
 
     @classmethod
     def get_epic_issues(cls, jira, project=None, epic=None):
@@ -22,28 +61,62 @@ class JiraTools:
         if epic:
             return cls.get_issue_list(jira, project, ["'Epic Link' = '{}'".format(epic)])
         else:
-            return cls.get_issue_list(jira, project, ["'Epic Link' is EMPTY",
-                                                      "issuetype != 'Epic'",
-                                                      "issuetype != 'Sub-task'",])
+            return cls.get_issue_list(jira, project, cls.no_epic_filters)
 
     @classmethod
-    def get_issue_list(cls, jira, project=None, filters=None):
-        n = 0
-        issues = []
-        filters = [] if not filters else filters
+    @Profiler.timed("JiraTools.get_issue_list", items=len)
+    def get_issue_list(cls, jira, project=None, filters=None, fields=None):
+        """
+        Returns all the issues matching the filters.
+        The first page gives the total number of issues and the page size accepted by the server:
+        the remaining pages are then fetched concurrently (within the limit of the Jira workers)
+        """
+        filters = list(filters or [])
         filters += ["project = '{}'".format(project)] if project else []
-        while "There are more issues":
-            batch = jira.search_issues("{} order by key asc".format(" and ".join(filters)),
-                                       startAt=n, maxResults=50, fields=cls.jira_fields, expand=["watcher", "watches", "watchers"])
-            issues.extend(batch)
-            n = n + len(batch)
-            if len(batch) < 50: break
+        jql = "{} order by key asc".format(" and ".join(filters))
+
+        def search(start, size):
+            return cls.throttle.call(jira.search_issues, jql, startAt=start, maxResults=size,
+                                     fields=fields or cls.fields(), expand=["watcher", "watches", "watchers"])
+
+        first = search(0, Config.get('jira', {}).get('page_size', cls.page_size))
+        issues = list(first)
+        page = len(first)  # unless it is the last one, the first page has the size accepted by the server
+        total = getattr(first, 'total', None)
+        if total is not None and page:
+            starts = range(page, total, page)
+            for start, batch in zip(starts, parallel_map(lambda n: search(n, page), starts, cls.workers())):
+                issues.extend(batch)
+                offset, missing = start + len(batch), min(page, total - start) - len(batch)
+                while missing > 0:  # a short page: the missing issues are requested again
+                    batch = search(offset, missing)
+                    if not batch: break
+                    issues.extend(batch)
+                    offset, missing = offset + len(batch), missing - len(batch)
+            if len(issues) != total:
+                logging.warning("Search '{}': {} issues loaded, {} expected (the issues may have changed during the "
+                                "search)".format(jql, len(issues), total))
+        elif total is None:  # no total available: read the pages one after another until a short page comes back
+            while page and len(issues) % page == 0:
+                batch = search(len(issues), page)
+                issues.extend(batch)
+                if len(batch) < page: break
         return issues
 
+    @classmethod
+    def count_issues(cls, jira, project=None, filters=None):
+        """
+        Returns the number of issues matching the filters, without loading them
+        (the search is sent directly: with maxResults=0, jira.search_issues loads all the pages)
+        """
+        filters = list(filters or [])
+        filters += ["project = '{}'".format(project)] if project else []
+        return cls.throttle.call(jira._get_json, 'search', params={'jql': " and ".join(filters), 'maxResults': 0,
+                                                                   'fields': 'key'})['total']
+
     @classmethod
     def get_subtasks(cls, jira, key):
-        return cls.get_issue_list(jira, filters=["issuetype = 'Sub-task'",
-                                                 "parent = '{}'".format(key)])
+        return cls.get_issue_list(jira, filters=cls.subtask_filters + ["parent = '{}'".format(key)])
 
 
     #@classmethod
@@ -54,4 +127,121 @@ class JiraTools:
 
     @classmethod
     def issue_watchers(cls, jira, issue):
-        return jira.watchers(issue).watchers
\ No newline at end of file
+        """
+        Returns the watchers of an issue.
+        The 'watches' field of the search payload is used when it is complete;
+        a separate request is sent only when Jira counts more watchers than were returned inline.
+        """
+        watches = getattr(issue.fields, 'watches', None)
+        inline = getattr(watches, 'watchers', None) or []
+        count = getattr(watches, 'watchCount', None)
+        if count is not None and count <= len(inline):
+            cls._count_watchers("inline")
+            return inline
+        cached = cls.snapshot.get_watchers(jira, issue) if cls.snapshot else None
+        if cached is not None:
+            cls._count_watchers("snapshot")
+            return cached
+        cls._count_watchers("fetched")
+        with Profiler.measure("JiraTools.watchers"):
+            watchers = cls.throttle.call(jira.watchers, issue).watchers
+        if cls.snapshot:
+            cls.snapshot.put_watchers(issue, watchers)
+        return watchers
+
+    @classmethod
+    def _count_watchers(cls, how):
+        with cls._stats_lock:
+            cls.watcher_stats[how] += 1
+
+    @classmethod
+    def log_watcher_stats(cls):
+        """Logs how the watchers were resolved since the start of the run (all the projects loaded so far)"""
+        stats = cls.watcher_stats
+        logging.info("Watchers (run totals): {} issues resolved from the search payload, {} from the snapshot "
+                     "({} requests saved), {} fetched separately".format(
+                         stats["inline"], stats["snapshot"], stats["inline"] + stats["snapshot"], stats["fetched"]))
+
+    @classmethod
+    def sprint_id(cls, value):
+        """
+        Returns the id of a sprint from the value of the sprint field (customfield_10115):
+        a parsed object on recent Jira versions, a serialized string on older ones
+        """
+        id = getattr(value, 'id', None)
+        return str(id) if id is not None else re.search("id=([0-9]+),", value).group(1)
+
+    @classmethod
+    def get_project_sprints(cls, jira, project):
+        """
+        Returns all the sprints of the scrum boards of a project, indexed by id
+        (a few paged calls, instead of one call per sprint)
+        """
+        sprints = {}
+        for board in cls._get_agile_pages(jira, 'board', {'projectKeyOrId': project, 'type': 'scrum'}):
+            for sprint in cls._get_agile_pages(jira, 'board/{}/sprint'.format(board['id'])):
+                sprints[str(sprint['id'])] = Sprint(jira._options, jira._session, raw=sprint)
+        if cls.snapshot:
+            [cls.snapshot.put_sprint(id, sprint) for id, sprint in sprints.items()]
+        return sprints
+
+    @classmethod
+    def _get_agile_pages(cls, jira, path, params=None):
+        """Returns all the values of a paged resource of the Jira Agile API"""
+        values = []
+        while "There are more values":
+            page = cls.throttle.call(jira._get_json, path, base=cls.agile_base,
+                                     params=dict(params or {}, startAt=len(values), maxResults=50))
+            values.extend(page.get('values', []))
+            if page.get('isLast', True) or not page.get('values'): break
+        return values
+
+    @classmethod
+    def get_sprint(cls, jira, id):
+        sprint = cls.snapshot.get_sprint(jira, id) if cls.snapshot else None
+        if not sprint:
+            sprint = cls.throttle.call(jira.sprint, id)
+            if cls.snapshot:
+                cls.snapshot.put_sprint(id, sprint)
+        return sprint
+
+
+class ProjectScan:
+    """
+    Loads all the issues of a project with a single paged search, then partitions them in memory
+    by issue type, epic link (customfield_10005) and parent.
+    It offers the same lookup methods as JiraTools, so that it can be used in its place to build a project
+    (unlike the JQL lookups, only the issues of the project itself are found in its epics).
+    """
+    def __init__(self, jira, project, issues=None):
+        """
+        :param issues: the issues of the project, if they are already loaded (see snapshot.Snapshot)
+        """
+        self.epics = []
+        self.no_epic = []
+        self.by_epic = defaultdict(list)
+        self.by_parent = defaultdict(list)
+        for issue in JiraTools.get_issue_list(jira, project) if issues is None else issues:
+            fields = issue.fields
+            issuetype = fields.issuetype.name
+            if issuetype == 'Epic':
+                self.epics.append(issue)
+            elif issuetype == 'Sub-task':
+                if getattr(fields, 'parent', None):
+                    self.by_parent[fields.parent.key].append(issue)
+            elif getattr(fields, 'customfield_10005', None):
+                self.by_epic[fields.customfield_10005].append(issue)
+            else:
+                self.no_epic.append(issue)
+        logging.info("Scanned project '{}': {} epics, {} issues in epics, {} issues without epic, {} subtasks".format(
+            project, len(self.epics), sum(len(l) for l in self.by_epic.values()), len(self.no_epic),
+            sum(len(l) for l in self.by_parent.values())))
+
+    def get_project_epics(self, jira, project):
+        return self.epics
+
+    def get_epic_issues(self, jira, project=None, epic=None):
+        return self.by_epic.get(epic, []) if epic else self.no_epic
+
+    def get_subtasks(self, jira, key):
+        return self.by_parent.get(key, [])
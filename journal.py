@@ -0,0 +1,54 @@
+import json
+import logging
+import os
+import threading
+
+class Journal:
+    """
+    Records the Clubhouse id of every object as soon as it is created (projects, epics, stories, comments,
+    tasks, files and links), keyed by the kind of object and its Jira reference.
+    The 'target' of the migrated objects is read from the journal; if the journal is written to a file,
+    an interrupted migration can be resumed: the objects already created are skipped.
+    Like the Config, the journal is stored in class variables, accessible from all objects.
+    """
+    ids = {}
+    resuming = False
+    _file = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, resume=False):
+        """
+        Opens the journal file: when resuming, the ids it contains are reloaded and new ones are appended,
+        otherwise the file is started afresh
+        """
+        cls.ids = {}
+        cls.resuming = resume
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # last line may be truncated if the previous run was killed while writing
+                        continue
+                    cls.ids[(entry["kind"], entry["key"])] = entry["id"]
+            logging.info("Resuming from journal '{}': {} objects already created".format(path, len(cls.ids)))
+        cls._file = open(path, 'a' if resume else 'w')
+
+    @classmethod
+    def get(cls, kind, key):
+        return cls.ids.get((kind, key))
+
+    @classmethod
+    def record(cls, kind, key, id):
+        """
+        Stores a new id; the file is flushed to disk before returning.
+        None forgets an id (e.g. the object was deleted): it is written only if an id was known
+        """
+        with cls._lock:
+            known = cls.ids.get((kind, key)) is not None
+            cls.ids[(kind, key)] = id
+            if cls._file and (id is not None or known):
+                cls._file.write(json.dumps({"kind": kind, "key": key, "id": id}) + "\n")
+                cls._file.flush()
+                os.fsync(cls._file.fileno())
@@ -1,4 +1,9 @@
+from concurrency import parallel_map
+from journal import Journal
+from profiler import Profiler
+import json
 import logging
+import threading
 
 class Link:
     """
@@ -6,6 +11,10 @@ class Link:
     It will dynamically resolve references in ako "lazy" manner
     """
     urlbase = "story-links"
+    __slots__ = ('origin', 'destination', 'link_type')
+    index = {}  # Jira key -> story, for all the projects of the run (see register)
+    _index_lock = threading.Lock()
+    symmetric = ("relates to",)  # verbs for which 'A verb B' and 'B verb A' are the same link
 
     def __init__(self, from_issue, to_issue, link_type):
         """
@@ -20,7 +29,39 @@ class Link:
         self.origin= from_issue
         self.destination = to_issue
         self.link_type = link_type
-        self.target_id = None
+
+    @property
+    def key(self):
+        """Reference of the link in the journal: 'subject key|verb|object key'"""
+        from issue import Issue
+        return "|".join(e.key if isinstance(e, Issue) else e for e in (self.origin, self.link_type, self.destination))
+
+    @property
+    def target_id(self):
+        """Clubhouse id of the link (None until it is created), kept in the journal"""
+        return Journal.get(self.urlbase, self.key)
+
+    @target_id.setter
+    def target_id(self, id):
+        Journal.record(self.urlbase, self.key, id)
+
+    @classmethod
+    def register(cls, stories):
+        """Adds stories to the run-wide index, so that the links from other projects can reach them"""
+        with cls._index_lock:
+            cls.index.update((s.key, s) for s in stories)
+
+    @classmethod
+    def find(cls, key):
+        """
+        Returns the Clubhouse id of a story given its Jira key: a story of the run (of any project),
+        or a story migrated by a previous run (found in the journal)
+        """
+        from issue import Story
+        story = cls.index.get(key)
+        if story is not None:
+            return story.target
+        return Journal.get(Story.urlbase, "JIRA_{}".format(key))
 
     @property
     def subject(self):
@@ -30,41 +71,75 @@ class Link:
         :return: a issue.Issue object (Story or Epic)
         """
         from issue import Issue
-        if isinstance(self.origin, Issue):
-            return self.origin
-        else:
-            self.origin = self.destination.project.issue_index[self.origin]
-            return self.origin
+        if not isinstance(self.origin, Issue) and self.origin in self.index:
+            self.origin = self.index[self.origin]
+        return self.origin if isinstance(self.origin, Issue) else None
 
     @property
     def object(self):
         """
-        Returns the target Issue of the link
+        Returns the target Issue of the link, if it belongs to one of the projects of the run
         Optionally resolves the link (replace the key with the referenced issue)
-        :return: a issue.Issue object (Story or Epic)
+        :return: a issue.Issue object (Story or Epic), or None
         """
         from issue import Issue
-        if isinstance(self.destination, Issue):
-            return self.destination
-        else:
-            try:
-                self.destination= self.origin.project.issue_index[self.destination]
-                return self.destination
-            except:
-                return None # target does not exist in the project
+        if not isinstance(self.destination, Issue) and self.destination in self.index:
+            self.destination = self.index[self.destination]
+        return self.destination if isinstance(self.destination, Issue) else None
+
+    def ends(self):
+        """Returns the Clubhouse ids of the subject and of the object of the link (None if not migrated)"""
+        from issue import Issue
+        return tuple(e.target if isinstance(e, Issue) else self.find(e) for e in (self.origin, self.destination))
 
     def json(self):
+        subject_id, object_id = self.ends()
         json = {
-            "object_id": self.object.target,
-            "subject_id": self.subject.target,
+            "object_id": object_id,
+            "subject_id": subject_id,
             "verb": self.link_type
         }
         return json if json["object_id"] and json["subject_id"] else None
 
+    @Profiler.timed("Link.save")
     def save(self, clubhouse):
-        if self.object and self.subject and self.object.target and self.subject.target:
-            response = clubhouse.post(self.urlbase, json=self.json())
+        if self.target_id:  # already created by a previous run
+            return
+        json = self.json()
+        if json:
+            response = clubhouse.post(self.urlbase, json=json)
             self.target_id = response["id"]
         else:
             logging.warning("Link between '{}' and '{}' not saved".format(self.origin, self.destination))
 
+    @classmethod
+    def save_all(cls, clubhouse, links, workers=1):
+        """
+        Creates the links of all the projects of the run, once all their stories exist:
+        the links are de-duplicated, then posted concurrently ('workers' requests, within the Clubhouse rate limit).
+        The links whose target could not be found (not migrated, or in a project that is not migrated) are reported
+        """
+        pending, unresolved, duplicates, done = {}, {}, 0, 0
+        for l in links:
+            if l.target_id:
+                done += 1
+                continue
+            subject_id, object_id = l.ends()
+            if not (subject_id and object_id):
+                unresolved.setdefault(l.destination if subject_id else l.origin, []).append(l)
+                continue
+            ends = (json.dumps(subject_id), json.dumps(object_id))  # the ids may be placeholders (see payloads.Exporter)
+            key = (frozenset(ends) if l.link_type in cls.symmetric else ends, l.link_type)
+            if key in pending:
+                duplicates += 1
+            else:
+                pending[key] = l
+        logging.info("Saving {} links".format(len(pending)))
+        parallel_map(lambda l: l.save(clubhouse), list(pending.values()), workers)
+        created = sum(1 for l in pending.values() if l.target_id)
+        logging.info("Links: {} created, {} not saved, {} already created, {} duplicates, {} unresolved".format(
+            created, len(pending) - created, done, duplicates, sum(len(u) for u in unresolved.values())))
+        for target, missing in sorted(unresolved.items(), key=lambda u: str(u[0])):
+            logging.warning("Unresolved link target '{}' ({} links, e.g. {})".format(
+                target, len(missing), missing[0].key))
+        return unresolved
@@ -0,0 +1,162 @@
+from attachment import Attachment
+from config import Config
+from contextlib import ExitStack
+from journal import Journal
+from project import Project
+import json
+import logging
+import os
+
+
+def ref(token):
+    """Placeholder for the Clubhouse id of an object that is only created when the payloads are loaded"""
+    return {"$ref": token}
+
+
+def resolve(value, ids):
+    """Replaces the placeholders found in a payload (or in a url) with the Clubhouse ids"""
+    if isinstance(value, dict):
+        if set(value) == {"$ref"}:
+            return ids[value["$ref"]]
+        return {k: resolve(v, ids) for k, v in value.items()}
+    if isinstance(value, list):
+        return [resolve(v, ids) for v in value]
+    return value
+
+
+class Exporter:
+    """
+    Writes the Clubhouse payloads of the projects to a JSONL file, instead of sending them to Clubhouse.
+    The exporter takes the place of the Clubhouse client in Project.save: every post is written as a record
+    and answered with placeholders ('#<record>' for the created object), so that the payloads that depend on it
+    (e.g. the comments of a story, the epic_id of a story) reference the placeholder.
+    The attachments are referenced by their path in the attachments folder; the file is replayed by the Loader.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'w')
+
+    def close(self):
+        self._file.close()
+        logging.info("Exported {} payloads to '{}'".format(self.count, self.path))
+
+    def write(self, method, **record):
+        """Writes a record, and returns its token"""
+        token = "#{}".format(self.count)
+        self._file.write(json.dumps(dict(record, n=self.count, method=method)) + "\n")
+        self.count += 1
+        return token
+
+    def export(self, project, bulk=False):
+        """Writes all the payloads of a project, in the order they are sent by Project.save"""
+        logging.info("Exporting project '{}'".format(project.name))
+        self.write("teardown", project=project.key, epics=[e.external_id for e in project.epics])
+        self.export_attachments(project)
+        project.save(self, bulk=bulk)
+
+    def export_attachments(self, project):
+        """
+        Writes the files to upload (identical files once), in batches as Attachment.upload_all does,
+        and gives the attachments a placeholder so that they are not uploaded by Project.save
+        """
+        attachments = [a for s in project.issue_index.values() if s.story_type for a in s.attachments]
+        folder = Config.get("attachments").get('folder')
+        batch_size = Attachment.batch_size()
+        by_hash = {}
+        for a in attachments:
+            by_hash.setdefault(a.digest(), []).append(a)
+        files = list(by_hash.values())
+        for i in range(0, len(files), batch_size):
+            batch = files[i:i + batch_size]
+            token = self.write("upload", files=[{
+                "name": same[0].filename,
+                "file": os.path.relpath(same[0].localfile, folder),
+                "mimeType": same[0].mimeType,
+                "hash": same[0].hash,
+            } for same in batch])
+            for j, same in enumerate(batch):
+                for a in same:
+                    a.target = ref("{}.{}".format(token, j))
+
+    # Clubhouse client interface, used by Project.save
+    def get(self, *segments, **kwargs):
+        return []  # nothing exists yet: nothing is deleted and no iteration is reused
+
+    def post(self, *segments, json=None, **kwargs):
+        if segments[-1] == 'bulk':
+            token = self.write("bulk", path=list(segments), json=json)
+            return [{
+                "external_id": s["external_id"],
+                "id": ref("{}.{}".format(token, i)),
+                "comments": [{"external_id": c["external_id"], "id": ref("{}.{}.comments.{}".format(token, i, j))}
+                             for j, c in enumerate(s.get("comments", []))],
+                "tasks": [{"external_id": t["external_id"], "id": ref("{}.{}.tasks.{}".format(token, i, j))}
+                          for j, t in enumerate(s.get("tasks", []))],
+            } for i, s in enumerate(json["stories"])]
+        return {"id": ref(self.write("post", path=list(segments), json=json))}
+
+
+class Loader:
+    """
+    Replays a file written by the Exporter against Clubhouse.
+    The file is read line by line; only the ids of the created objects are kept (token -> Clubhouse id).
+    Each record is recorded in the journal once it is done, so that an interrupted load can be resumed.
+    """
+    def __init__(self, clubhouse):
+        self.clubhouse = clubhouse
+        self.ids = {}
+
+    def load(self, path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                done = Journal.get('records', record["n"])
+                if done is not None:
+                    self.ids.update(done)
+                    continue
+                ids = getattr(self, record["method"])(record)
+                Journal.record('records', record["n"], ids)
+                self.ids.update(ids)
+        logging.info("Loaded '{}': {} objects created".format(path, len(self.ids)))
+
+    def teardown(self, record):
+        if not Journal.resuming:
+            Project.teardown(self.clubhouse, record["project"], record["epics"])
+        return {}
+
+    def upload(self, record):
+        """Uploads the files that have not already been uploaded (see Attachment.upload_all)"""
+        token = "#{}".format(record["n"])
+        folder = Config.get("attachments").get('folder')
+        if not Attachment.uploaded:
+            Attachment.load_uploaded()
+        pending = [f for f in record["files"] if f["hash"] not in Attachment.uploaded]
+        if pending:
+            with ExitStack() as stack:
+                files = {"file{}".format(i): (f["name"], stack.enter_context(open(os.path.join(folder, f["file"]), 'rb')),
+                                              f["mimeType"]) for i, f in enumerate(pending)}
+                response = self.clubhouse.post('files', files=files)
+            Attachment.check_uploaded(pending, response)
+            Attachment._record_uploaded({f["hash"]: r["id"] for f, r in zip(pending, response)})
+        return {"{}.{}".format(token, j): Attachment.uploaded[f["hash"]] for j, f in enumerate(record["files"])}
+
+    def post(self, record):
+        response = self.clubhouse.post(*resolve(record["path"], self.ids), json=resolve(record["json"], self.ids))
+        return {"#{}".format(record["n"]): response["id"]}
+
+    def bulk(self, record):
+        """Creates a batch of stories; the created comments and tasks are matched by external id"""
+        token = "#{}".format(record["n"])
+        stories = resolve(record["json"], self.ids)["stories"]
+        response = self.clubhouse.post(*resolve(record["path"], self.ids), json={"stories": stories})
+        created = {r["external_id"]: r for r in response}
+        ids = {}
+        for i, s in enumerate(stories):
+            story = created[s["external_id"]]
+            ids["{}.{}".format(token, i)] = story["id"]
+            for field in ("comments", "tasks"):
+                answered = {c.get("external_id"): c["id"] for c in story.get(field, [])}
+                for j, c in enumerate(s.get(field, [])):
+                    ids["{}.{}.{}.{}".format(token, i, field, j)] = answered.get(c["external_id"])
+        return ids
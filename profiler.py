@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+import functools
+import json
+import logging
+import re
+import threading
+import time
+
+
+class Profiler:
+    """
+    Collects the metrics of a migration (option --profile), by phase:
+    - for each HTTP endpoint of Jira and Clubhouse: calls, errors, bytes sent and received, latency histogram
+      (the size of the streamed answers without Content-Length is unknown: they are counted as 'unmeasured')
+    - for each instrumented operation (see timed): calls, items processed, latency histogram
+    Like the Config, the profiler is stored in class variables, accessible from all objects;
+    when it is not enabled, the instrumented code only pays for a test.
+    """
+    enabled = False
+    buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # upper bounds of the latency histograms (seconds)
+    phases = OrderedDict()  # phase -> {"seconds": wall time, "endpoints": {name: stats}, "operations": {name: stats}}
+    current = "setup"
+    _lock = threading.Lock()
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+        cls.phases = OrderedDict()
+        cls.current = "setup"
+
+    @classmethod
+    @contextmanager
+    def phase(cls, name):
+        """Attributes everything measured in the block to a phase (the time of repeated phases is added up)"""
+        previous, cls.current = cls.current, name
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with cls._lock:
+                cls._phase(name)["seconds"] += time.perf_counter() - started
+            cls.current = previous
+
+    @classmethod
+    def _phase(cls, name):
+        return cls.phases.setdefault(name, {"seconds": 0.0, "endpoints": {}, "operations": {}})
+
+    @classmethod
+    def _record(cls, kind, name, seconds, items=1, error=False, sent=0, received=0):
+        with cls._lock:
+            stats = cls._phase(cls.current)[kind].setdefault(name, {
+                "calls": 0, "items": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "bytes_sent": 0,
+                "bytes_received": 0, "unmeasured": 0, "histogram": [0] * (len(cls.buckets) + 1)})
+            stats["calls"] += 1
+            stats["items"] += items
+            stats["errors"] += 1 if error else 0
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["bytes_sent"] += sent
+            if received is None:
+                stats["unmeasured"] += 1
+            else:
+                stats["bytes_received"] += received
+            stats["histogram"][next((i for i, b in enumerate(cls.buckets) if seconds <= b), len(cls.buckets))] += 1
+
+    @classmethod
+    @contextmanager
+    def measure(cls, name, items=1):
+        """Measures the operation run in the block (see timed)"""
+        if not cls.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            cls._record("operations", name, time.perf_counter() - started, 0, error=True)
+            raise
+        cls._record("operations", name, time.perf_counter() - started, items)
+
+    @classmethod
+    def timed(cls, name, items=None):
+        """
+        Decorator that measures an operation
+        :param items: function giving the number of items processed from the result (default: 1 per call)
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not cls.enabled:
+                    return function(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    result = function(*args, **kwargs)
+                except Exception:
+                    cls._record("operations", name, time.perf_counter() - started, 0, error=True)
+                    raise
+                cls._record("operations", name, time.perf_counter() - started, items(result) if items else 1)
+                return result
+            return wrapper
+        return decorator
+
+    @classmethod
+    def endpoint(cls, method, url):
+        """Name of an endpoint: method, host and path without the API version, the ids and keys being replaced with '{id}'"""
+        url = urlparse(url)
+        path = re.sub(r'/(api|agile)/v?[0-9.]+/', r'/\1/', url.path)
+        return "{} {}{}".format(method, url.hostname, re.sub(r'/[^/]*[0-9][^/]*(?=/|$)', '/{id}', path))
+
+    @classmethod
+    def response(cls, response, *args, **kwargs):
+        """
+        Hook of the requests library, called for each HTTP response (see hook).
+        The bytes received are given by the Content-Length; without it, the body is read here rather than just after
+        the hook, and the bytes read from the connection are counted. The size of a streamed body (e.g. an attachment)
+        and of a chunked body (not counted by urllib3) is unknown
+        """
+        request = response.request
+        body = request.body or b''
+        received = response.headers.get('Content-Length')
+        if received is None and not kwargs.get('stream') and hasattr(response.raw, 'tell'):
+            received = response.raw.tell() if response.content else 0
+            received = received or None
+        cls._record("endpoints", cls.endpoint(request.method, request.url), response.elapsed.total_seconds(),
+                    error=response.status_code >= 400, sent=len(body) if isinstance(body, (bytes, str)) else 0,
+                    received=int(received) if received is not None else None)
+        return response
+
+    @classmethod
+    def hook(cls, session):
+        """Records the responses received by a requests session (e.g. the session of the JIRA client)"""
+        session.hooks.setdefault('response', []).append(cls.response)
+
+    @classmethod
+    def percentile(cls, histogram, fraction):
+        """Upper bound of the histogram bucket that contains the given fraction of the calls"""
+        total, count = sum(histogram), 0
+        for bound, n in zip(cls.buckets + [float('inf')], histogram):
+            count += n
+            if total and count >= fraction * total:
+                return bound
+        return 0
+
+    @classmethod
+    def report(cls):
+        """Returns the metrics, with the histograms labelled by their upper bound"""
+        labels = ["<={}s".format(b) for b in cls.buckets] + [">{}s".format(cls.buckets[-1])]
+        return {"histogram_buckets": labels, "phases": cls.phases}
+
+    @classmethod
+    def save(cls, path):
+        with open(path, 'w') as f:
+            json.dump(cls.report(), f, indent=2)
+        logging.info("Profile written to '{}'".format(path))
+
+    @classmethod
+    def summary(cls):
+        """Returns a human readable summary: items per second for each phase, then the costliest endpoints"""
+        lines = ["{:<12}{:>10}{:>10}{:>12}{:>10}".format("phase", "time (s)", "requests", "MB in/out", "items/s")]
+        for name, p in cls.phases.items():
+            requests = sum(e["calls"] for e in p["endpoints"].values())
+            traffic = sum(e["bytes_received"] + e["bytes_sent"] for e in p["endpoints"].values())
+            items = sum(o["items"] for o in p["operations"].values())
+            unmeasured = sum(e["unmeasured"] for e in p["endpoints"].values())
+            lines.append("{:<12}{:>10.1f}{:>10}{:>12.1f}{:>10.1f}{}".format(
+                name, p["seconds"], requests, traffic / 2 ** 20, items / p["seconds"] if p["seconds"] else 0,
+                "  (+ {} answers of unknown size)".format(unmeasured) if unmeasured else ""))
+        for kind in ("operations", "endpoints"):
+            lines.append("{:<12}{:<52}{:>7}{:>7}{:>9}{:>9}{:>9}".format(
+                "phase", kind, "calls", "errors", "total s", "p50 <=", "p95 <="))
+            rows = [(p, n, s) for p, phase in cls.phases.items() for n, s in phase[kind].items()]
+            for p, n, s in sorted(rows, key=lambda r: -r[2]["seconds"])[:15]:
+                lines.append("{:<12}{:<52}{:>7}{:>7}{:>9.1f}{:>9}{:>9}".format(
+                    p, n[:51], s["calls"], s["errors"], s["seconds"],
+                    cls.percentile(s["histogram"], 0.5), cls.percentile(s["histogram"], 0.95)))
+        return "\n".join(lines)
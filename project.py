@@ -1,97 +1,457 @@
+from attachment import Attachment
+from concurrency import parallel_map
 from config import Config
-from jiratools import JiraTools
+from jiratools import JiraTools, ProjectScan
 from issue import Epic, Story
-from registry import Members
+from collections import Counter
+from journal import Journal
+from link import Link
+from resolver import Resolver
+from scheduler import WriteScheduler
+import hashlib
+import json
 import logging
+import queue
+import threading
 
 class Project:
     urlbase = 'projects'
 
-    def __init__(self, jira_client, key):
-        self.source = jira_client.project(key)
-        self.target = None
-        self.name = self.source.name
+    def __init__(self, jira_client, key, scan=False, extract=True):
+        """
+        Loads a project from Jira.
+        :param scan: if True, all issues are loaded with a single paged search and partitioned in memory,
+                     instead of running one search per epic and per parent issue.
+                     If a snapshot is defined (JiraTools.snapshot), the issues are read from the snapshot
+                     after it has been refreshed.
+        :param extract: if False, only the project itself is loaded, its content is extracted later by stream()
+        """
+        source = JiraTools.get_project(jira_client, key)
+        self.key = source.key
+        self.name = source.name
 
         self.sprints = {}
-        self.description = self.source.description
-        self.owner = Config.get('users').get(self.source.lead.name)
+        self.catalogue = None  # sprints of the project boards, see prefetch_sprints
+        self.previous_epics = {}  # epics of a previous attempt, see delete
+        self.description = source.description
+        self.owner = Config.get('users').get(source.lead.name)
+        self.epics = []
+        self.no_epics = []
+        self.issue_index = {}
+        self.written_links = []  # links of the issues written by stream(), by Jira key (see links)
+        if extract:
+            self.extract(jira_client, scan)
+
+    def finder(self, jira_client, scan):
+        """Returns where to look for the issues of the project: JiraTools (Jira searches) or a ProjectScan"""
+        if JiraTools.snapshot:
+            return ProjectScan(jira_client, self.key, JiraTools.snapshot.refresh(jira_client, self.key))
+        elif scan:
+            return ProjectScan(jira_client, self.key)
+        else:
+            return JiraTools
+
+    def extract(self, jira_client, scan=False):
+        """Loads all the epics, stories and subtasks of the project"""
+        with Resolver.scope(self.key):
+            self._extract(jira_client, scan)
+
+    def _extract(self, jira_client, scan):
+        finder = self.finder(jira_client, scan)
         # Get all epics in project (and collect the issues in each epic)
-        self.epics = [Epic(jira_client,e) for e in JiraTools.get_project_epics(jira_client, self.source.key)]
+        # (the epics and the issues are independent: they are built concurrently if several Jira workers are allowed)
+        workers = JiraTools.workers()
+        self.epics = parallel_map(lambda e: Epic(jira_client, e, finder),
+                                  finder.get_project_epics(jira_client, self.key), workers)
         # Also collect the issues without an epic
-        self.no_epics = [Story(jira_client, s) for s in JiraTools.get_epic_issues(jira_client, self.source.key, None)]
+        self.no_epics = parallel_map(lambda s: Story(jira_client, s, finder),
+                                     finder.get_epic_issues(jira_client, self.key, None), workers)
+        # Fetch the sprints once for all issues, before the issues are attached to them
+        self.prefetch_sprints(jira_client)
         # setup links to self in the children
         for s in self.no_epics + self.epics:
             s.project = self
-        self.issue_index = {s.source.key: s for s in self.no_epics}
-        self.issue_index.update({s.source.key: s for e in self.epics for s in e.stories})
+        self.issue_index = {s.key: s for s in self.no_epics}
+        self.issue_index.update({s.key: s for e in self.epics for s in e.stories})
+        Link.register(self.issue_index.values())
+
+    @property
+    def target(self):
+        """Clubhouse id of the project (None until it is created), kept in the journal"""
+        return Journal.get(self.urlbase, self.key)
+
+    @target.setter
+    def target(self, id):
+        Journal.record(self.urlbase, self.key, id)
 
     def __str__(self):
-        return "<Project {} '{}'>".format(self.source.key, self.name)
+        return "<Project {} '{}'>".format(self.key, self.name)
 
     def json(self):
         json = {
-            "description": "{}".format(self.source.description),
-            "external_id": self.source.key,
+            "description": "{}".format(self.description),
+            "external_id": self.key,
             "name": self.name,
         }
         return json
 
-    def save(self, clubhouse):
-        self.delete(clubhouse)
-        logging.info("Saving target project '{}'".format(self.name))
-        response = clubhouse.post(self.urlbase, json=self.json())
-        self.target = response['id']
+    def download_attachments(self, jira_client):
+        """Downloads the files attached to the stories (the only ones that are uploaded to Clubhouse)"""
+        logging.info("Downloading attachments")
+        Attachment.download_all(jira_client, (a for s in self.issue_index.values() for a in s.attachments))
+
+    def save(self, clubhouse, bulk=False, workers=1):
+        """
+        Creates the project and all its content in Clubhouse, except the links: they are saved once all the projects
+        of the run are saved (see links() and link.Link.save_all).
+        A previous attempt is deleted first, unless the migration is resumed (see journal.Journal)
+        :param bulk: if True, the stories are created in batches, with their comments and subtasks (see Story.save_bulk)
+        :param workers: if more than 1, independent writes run concurrently (see schedule)
+        """
+        if not Journal.resuming:
+            self.delete(clubhouse, workers)
+        if workers > 1:
+            scheduler = WriteScheduler(workers)
+            self.schedule(scheduler, clubhouse, bulk)
+            scheduler.run()
+            return
+        self.create(clubhouse)
+        self.upload_attachments(clubhouse)
+        Sprint.save_all(clubhouse, self.sprints.values())
         logging.info("Saving epics")
         for e in self.epics:
-            e.save(clubhouse)
-        logging.info("Saving stories without epics")
-        for s in self.no_epics:
-            s.save(clubhouse)
-        # save all links (must be done after all stories are saved)
-        logging.info("Saving links")
-        [l.save(clubhouse) for key,s in self.issue_index.items() for l in s.links]
-
-        logging.info("Saving sprints")
-        for key, s in self.sprints.items():
-            s.save(clubhouse)
-
-    def delete(self, clubhouse):
-        """Deletes a project and the stories it contains"""
-        # TO DO: delete epics as well
-        projects = clubhouse.get(self.urlbase)
-        the_project = next((p for p in projects if p['external_id'] == self.source.key), None)
+            e.save(clubhouse, with_stories=not bulk)
+        if bulk:
+            logging.info("Saving stories in bulk")
+            Story.save_bulk(clubhouse, [s for e in self.epics for s in e.stories] + self.no_epics)
+        else:
+            logging.info("Saving stories without epics")
+            for s in self.no_epics:
+                s.save(clubhouse)
+
+    def links(self):
+        """Returns the links of the stories of the project"""
+        return self.written_links + [l for s in self.issue_index.values() for l in s.links]
+
+    def create(self, clubhouse):
+        """Creates the project itself (unless it was already created by a previous run)"""
+        if not self.target:
+            logging.info("Saving target project '{}'".format(self.name))
+            response = clubhouse.post(self.urlbase, json=self.json())
+            self.target = response['id']
+            Journal.record('hashes', self.key, self.digest())
+
+    def digest(self):
+        return hashlib.sha256(json.dumps(self.json(), sort_keys=True).encode()).hexdigest()
+
+    def sync(self, clubhouse, workers=1):
+        """
+        Brings a previous migration of the project up to date, instead of deleting and recreating it:
+        the project, its epics and its stories are listed once from Clubhouse and matched by external id,
+        then only the objects whose payload has changed since the previous run (hashes kept in the journal)
+        are created, updated or deleted; see Issue.sync
+        """
+        projects = {p['external_id']: p['id'] for p in clubhouse.get(self.urlbase)}
+        if self.key not in projects:
+            self.target = None
+            self.create(clubhouse)
+        else:
+            if self.target != projects[self.key]:
+                self.target = projects[self.key]
+            if Journal.get('hashes', self.key) != self.digest():
+                json = self.json()
+                del json['external_id']
+                clubhouse.put(self.urlbase, self.target, json=json)
+                Journal.record('hashes', self.key, self.digest())
+        epics = {e['external_id']: e for e in clubhouse.get(Epic.urlbase)}
+        stories = {s['external_id']: s for s in clubhouse.get(self.urlbase, self.target, 'stories')}
+        self.upload_attachments(clubhouse)
+        Sprint.save_all(clubhouse, self.sprints.values(), workers)
+        changes = Counter(parallel_map(lambda e: "epics " + e.sync(clubhouse, epics.pop(e.external_id, None)),
+                                       self.epics, workers))
+        states = parallel_map(lambda s: s.sync(clubhouse, stories.pop(s.external_id, None)),
+                              self.issue_index.values(), workers)
+        changes.update("stories " + state for state in states)
+        # the objects that are no longer in Jira (the objects created in Clubhouse, without a Jira external id, are kept)
+        prefix = "JIRA_{}-".format(self.key)  # the epics list is not per project
+        story_ids = [s['id'] for ext, s in stories.items() if ext and ext.startswith(prefix)]
+        batch_size = Config.get('clubhouse', {}).get('batch_size', 50)
+        for i in range(0, len(story_ids), batch_size):
+            clubhouse.delete(Story.urlbase, 'bulk', json={"story_ids": story_ids[i:i + batch_size]})
+        epic_ids = [e['id'] for ext, e in epics.items() if ext and ext.startswith(prefix)]
+        parallel_map(lambda id: clubhouse.delete(Epic.urlbase, id), epic_ids, workers)
+        changes.update({"stories deleted": len(story_ids), "epics deleted": len(epic_ids)})
+        created = {key for key, state in zip(self.issue_index, states) if state == 'created'}
+        changes.update(self.sync_links(clubhouse, created))
+        logging.info("Synchronized {}: {}".format(self, ", ".join(
+            "{} {}".format(n, change) for change, n in sorted(changes.items()) if n)))
+        return changes
+
+    def sync_links(self, clubhouse, created=()):
+        """
+        Deletes the links that are gone, by key ('subject|verb|object'); the new links are created with those of the
+        other projects (see link.Link.save_all)
+        :param created: the keys of the stories (re)created by the sync: their previous links no longer exist
+        """
+        current = {l.key for s in self.issue_index.values() for l in s.links}
+        issues = set(self.issue_index)
+        links = [(key, id) for (kind, key), id in list(Journal.ids.items()) if kind == Link.urlbase and id]
+        for key, id in links:
+            subject, verb, destination = key.split("|")
+            if subject in created or destination in created:
+                Journal.record(Link.urlbase, key, None)
+        gone = [key for key, id in links
+                if key.split("|")[0] in issues and key not in current and Journal.get(Link.urlbase, key)]
+        for key in gone:
+            clubhouse.delete(Link.urlbase, Journal.get(Link.urlbase, key))
+            Journal.record(Link.urlbase, key, None)
+        return {"links deleted": len(gone)}
+
+    def upload_attachments(self, clubhouse):
+        logging.info("Uploading attachments")
+        Attachment.upload_all(clubhouse, (a for s in self.issue_index.values() if s.story_type for a in s.attachments))
+
+    def schedule(self, scheduler, clubhouse, bulk=False):
+        """
+        Adds all the writes of the project to a WriteScheduler, with their dependencies:
+        files, sprints, epics and the project before the stories; stories before their comments and subtasks.
+        Once an issue is written with its comments and subtasks, its digest is recorded (see sync)
+        """
+        project = scheduler.add(str(self), lambda: self.create(clubhouse))
+        files = scheduler.add("Attachments of {}".format(self), lambda: self.upload_attachments(clubhouse))
+        iterations = scheduler.add("Sprints of {}".format(self),
+                                   lambda: Sprint.save_all(clubhouse, self.sprints.values(), scheduler.workers))
+        tasks = {}  # issue -> task that creates it
+        for e in self.epics:
+            tasks[e] = scheduler.add(str(e), lambda e=e: e.create(clubhouse))
+        stories = [s for e in self.epics for s in e.stories] + self.no_epics
+        for s in stories:
+            if not s.story_type:
+                s.save(clubhouse)  # only logs that the story is not saved
+        stories = [s for s in stories if s.story_type]
+        inline = [s for s in stories if bulk and not s.target]  # comments and subtasks are created with the story
+        for batch in Story.batches(inline):
+            task = scheduler.add("Stories {}..{}".format(batch[0].key, batch[-1].key),
+                                 lambda b=batch: Story.create_bulk(clubhouse, b),
+                                 after=[project, files, iterations] + [tasks[s.epic] for s in batch if s.epic])
+            tasks.update((s, task) for s in batch)
+        for s in stories:
+            if s not in tasks:
+                tasks[s] = scheduler.add(str(s), lambda s=s: s.create(clubhouse),
+                                         after=[project, files, iterations, tasks.get(s.epic)])
+        inline = set(inline)
+        for i in [i for i in tasks if i not in inline]:  # the stories created in bulk record their digest
+            writes = [tasks[i]]
+            for c in i.comments:
+                if not c.target:
+                    writes.append(scheduler.add("Comment {} of {}".format(c.key, i), lambda c=c: c.save(clubhouse),
+                                                after=[tasks[i]]))
+            for t in i.subtasks or []:
+                if not t.target:
+                    writes.append(scheduler.add(str(t), lambda t=t: t.save(clubhouse), after=[tasks[i]]))
+            scheduler.add("Digest of {}".format(i), i.record_digest, after=writes)
+
+    def delete(self, clubhouse, workers=1):
+        """Deletes a previous migration of the project (see teardown)"""
+        self.previous_epics = self.teardown(clubhouse, self.key, [e.external_id for e in self.epics], workers)
+
+    @classmethod
+    def teardown(cls, clubhouse, key, epics, workers=1):
+        """
+        Deletes a previous migration of a project: its stories, the given epics (by external id) and the project itself.
+        Each list is loaded once and indexed by external id; the stories are deleted in bulk,
+        the epics (which have no bulk delete) with 'workers' concurrent requests
+        :return: the other epics in Clubhouse (external id -> id), see delete_previous_epic
+        """
+        projects = {p['external_id']: p for p in clubhouse.get(cls.urlbase)}
+        previous_epics = {e['external_id']: e['id'] for e in clubhouse.get(Epic.urlbase)}
+        the_project = projects.get(key)
         if the_project:
             logging.info("Deleting target project #{}".format(the_project['id']))
-            stories = clubhouse.get(self.urlbase, the_project['id'], 'stories')
-            for s in stories:
-                clubhouse.delete(Story.urlbase, s['id'])
-            clubhouse.delete(self.urlbase, the_project['id'])
+            story_ids = [s['id'] for s in clubhouse.get(cls.urlbase, the_project['id'], 'stories')]
+            batch_size = Config.get('clubhouse', {}).get('batch_size', 50)
+            for i in range(0, len(story_ids), batch_size):
+                clubhouse.delete(Story.urlbase, 'bulk', json={"story_ids": story_ids[i:i + batch_size]})
+            logging.info("Deleted {} stories".format(len(story_ids)))
+        epic_ids = [previous_epics.pop(e) for e in epics if e in previous_epics]
+        parallel_map(lambda id: clubhouse.delete(Epic.urlbase, id), epic_ids, workers)
+        if epic_ids:
+            logging.info("Deleted {} epics".format(len(epic_ids)))
+        if the_project:
+            clubhouse.delete(cls.urlbase, the_project['id'])
+        return previous_epics
+
+    def delete_previous_epic(self, clubhouse, epic):
+        """Deletes the epic created by a previous attempt, if any (delete must have been called first)"""
+        id = self.previous_epics.pop(epic.external_id, None)
+        if id:
+            clubhouse.delete(Epic.urlbase, id)
+        return bool(id)
+
+    def stream(self, jira_client, clubhouse, scan=False, bulk=False, queue_size=10):
+        """
+        Extracts and saves the project at the same time: the epics (with their stories) and the stories without epic
+        flow from a reader thread to the writer through a queue of at most 'queue_size' items, so that Jira and
+        Clubhouse are used at the same time and only a few items are waiting in memory.
+        Each item is written as soon as it arrives (after its mapping is checked), then released: only the links
+        are kept, by Jira key, to be saved with those of the other projects (see links() and link.Link.save_all);
+        their ends are found in the journal.
+        """
+        items = queue.Queue(queue_size)
+        reader = threading.Thread(target=self._read, args=(jira_client, scan, items), daemon=True)
+        reader.start()
+        if not Journal.resuming:
+            self.delete(clubhouse)
+        self.create(clubhouse)
+        existing_iterations = Sprint.existing(clubhouse) if Sprint.enabled() else None
+        while "There are more items":
+            item = items.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if not Resolver.check():
+                raise ValueError("Incomplete mapping in {}".format(item))
+            stories = item.stories if isinstance(item, Epic) else item
+            issues = [item] + stories if isinstance(item, Epic) else stories
+            Attachment.upload_all(clubhouse, (a for s in stories if s.story_type for a in s.attachments))
+            Sprint.save_all(clubhouse, {sp for i in issues for sp in i.sprints}, existing=existing_iterations)
+            if isinstance(item, Epic):
+                if not Journal.resuming:
+                    self.delete_previous_epic(clubhouse, item)
+                item.save(clubhouse, with_stories=not bulk)
+            if bulk:
+                Story.save_bulk(clubhouse, stories)
+            elif not isinstance(item, Epic):
+                [s.save(clubhouse) for s in stories]
+            self.written_links += [Link(s.key, getattr(l.destination, "key", l.destination), l.link_type)
+                                   for s in stories for l in s.links]
+            self.release(issues)
+
+    def release(self, issues):
+        """Removes written issues from their sprints, the only references to them left once they are written"""
+        written = set(map(id, issues))
+        for sprint in {sp for i in issues for sp in i.sprints}:
+            sprint.issues = [i for i in sprint.issues if id(i) not in written]
+
+    def _read(self, jira_client, scan, items):
+        """Reader side of stream(): puts the epics, then batches of stories without epic, then None in the queue"""
+        try:
+            finder = self.finder(jira_client, scan)
+            for jira_epic in finder.get_project_epics(jira_client, self.key):
+                epic = Epic(jira_client, jira_epic, finder)
+                self._prepare(jira_client, [epic], epic.stories)
+                items.put(epic)
+            for batch in Story.batches(finder.get_epic_issues(jira_client, self.key, None)):
+                stories = parallel_map(lambda s: Story(jira_client, s, finder), batch, JiraTools.workers())
+                self._prepare(jira_client, stories, stories)
+                items.put(stories)
+            items.put(None)
+        except Exception as e:
+            items.put(e)
+
+    def _prepare(self, jira_client, children, stories):
+        """Attaches the issues to the project (and to their sprints) and downloads the attachments of the stories"""
+        self.prefetch_sprints(jira_client, [i for c in children for i in [c] + getattr(c, 'stories', [])])
+        for c in children:
+            c.project = self
+        Attachment.download_all(jira_client, (a for s in stories for a in s.attachments))
+
+    def prefetch_sprints(self, jira_client, issues=None):
+        """
+        Loads all the sprints referenced by the issues (by default all the issues of the project): from the catalogue
+        of the sprints of the project boards, or (concurrently) one by one for the sprints of other boards
+        """
+        if issues is None:
+            issues = self.no_epics + [i for e in self.epics for i in [e] + e.stories]
+        ids = [id for id in dict.fromkeys(id for i in issues for id in i.sprints) if id not in self.sprints]
+        if not ids:
+            return
+        if self.catalogue is None:
+            self.catalogue = JiraTools.get_project_sprints(jira_client, self.key)
+        sprints = parallel_map(lambda id: Sprint(jira_client, id, self.catalogue.get(id)), ids, JiraTools.workers())
+        self.sprints.update(zip(ids, sprints))
 
     def add_to_sprints(self, issue, sprint_ids):
-        # TODO: refactor this code - it is not very elegant
-        sprint_objects = []
-        for id in sprint_ids:
-            if id in self.sprints:
-                sprint = self.sprints[id]
-            else:
-                sprint = Sprint(issue.jira_client,id)
-                self.sprints[id] = sprint
+        """Replaces the sprint ids of an issue with the sprints (all loaded beforehand by prefetch_sprints)"""
+        issue.sprints = [self.sprints[id] for id in sprint_ids]
+        for sprint in issue.sprints:
             sprint.add_issue(issue)
-            sprint_objects.append(sprint)
-        issue.sprints = sprint_objects
 
 class Sprint:
-    def __init__(self, jira_client, id):
-        jira_sprint = jira_client.sprint(id)
-        self.source = jira_sprint
+    urlbase = 'iterations'
+    __slots__ = ('id', 'name', 'start_date', 'end_date', 'issues')
+    _locks = {}  # sprint id -> lock: a sprint may be shared by projects migrated at the same time, it is created once
+    _locks_lock = threading.Lock()  # guards _locks only, never held during a request
+
+    def __init__(self, jira_client, id, jira_sprint=None):
+        """
+        :param jira_sprint: the sprint loaded from Jira, if it is already known (see JiraTools.get_project_sprints)
+        """
+        jira_sprint = jira_sprint or JiraTools.get_sprint(jira_client, id)
+        self.id = str(id)
         self.name = jira_sprint.name
+        self.start_date = getattr(jira_sprint, 'startDate', None)
+        self.end_date = getattr(jira_sprint, 'endDate', None)
         self.issues = []
 
+    @property
+    def target(self):
+        """Clubhouse id of the iteration (None if the sprint is not saved as an iteration), kept in the journal"""
+        return Journal.get(self.urlbase, self.id)
+
+    @target.setter
+    def target(self, id):
+        Journal.record(self.urlbase, self.id, id)
+
     def add_issue(self, issue):
         self.issues.append(issue)
 
-    def save(self, clubhouse):
-        """Sprints are saved as labels (not as interations).
-        Reason: Jira sprints are not required to have start/end dates - but Clubhouse iterations do.
-        => no save procedure, the sprint info is saved in the Issue.save() method"""
-        pass
+    def json(self):
+        return {
+            "name": self.name,
+            "start_date": self.start_date[:10],
+            "end_date": self.end_date[:10],
+        }
+
+    def _lock(self):
+        with self._locks_lock:
+            return self._locks.setdefault(self.id, threading.Lock())
+
+    def save(self, clubhouse, existing=None):
+        """Sprints are always saved as labels, in the Issue.json() method.
+        If configured ('sprints' / 'iterations' = true), the sprints that have start/end dates are also saved as
+        iterations - Jira sprints are not required to have dates, but Clubhouse iterations do.
+        :param existing: the iterations already in Clubhouse (see existing): an iteration with the same name and dates
+                         is reused (sprints of different boards often have the same name)"""
+        if not (self.start_date and self.end_date):
+            return
+        with self._lock():  # the other sprints are created meanwhile
+            if self.target:
+                return
+            json = self.json()
+            key = (json["name"], json["start_date"], json["end_date"])
+            if existing and key in existing:
+                self.target = existing[key]
+            else:
+                response = clubhouse.post(self.urlbase, json=json)
+                self.target = response["id"]
+
+    @classmethod
+    def enabled(cls):
+        """Tells if the sprints are saved as iterations ('sprints' / 'iterations' in the configuration)"""
+        return Config.get('sprints', {}).get('iterations', False)
+
+    @classmethod
+    def existing(cls, clubhouse):
+        """Returns the iterations already in Clubhouse ((name, start date, end date) -> id)"""
+        return {(i['name'], i.get('start_date'), i.get('end_date')): i['id'] for i in clubhouse.get(cls.urlbase)}
+
+    @classmethod
+    def save_all(cls, clubhouse, sprints, workers=1, existing=None):
+        """Creates the iterations concurrently, before the stories that reference them"""
+        if not cls.enabled():
+            return
+        logging.info("Saving sprints as iterations")
+        existing = cls.existing(clubhouse) if existing is None else existing
+        parallel_map(lambda s: s.save(clubhouse, existing), list(sprints), workers)
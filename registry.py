@@ -1,3 +1,11 @@
+from config import Config
+from profiler import Profiler
+import hashlib
+import json
+import logging
+import os
+import time
+
 class Registry():
     """
     Abstract class for representing clubhouse reference elements like: users, states, etc.
@@ -8,15 +16,44 @@ class Registry():
     id_key = 'id'
     element_list_key = None
     items = {}
+    workspace = None  # the cached elements are only valid in one Clubhouse workspace (see set_workspace)
     #mapping = None
 
     #_elements = {}  # local static storage of raw elements (= ref/id pairs loaded from CH)
     #_dict = {} # local static storage of initialize elements (= jira/element pairs)
 
     @classmethod
+    @Profiler.timed("Registry.init")
     def init(cls, clubhouse_client):
         cls.items = {cls.extract_reference(e): cls.extract_id(e)
-                     for e in cls.load_source_elements(clubhouse_client.get(cls.urlbase))}
+                     for e in cls.load_source_elements(cls.fetch(clubhouse_client))}
+
+    @classmethod
+    def set_workspace(cls, token):
+        """Scopes the cache to a Clubhouse token (a token gives access to one workspace); called on Registry for all"""
+        cls.workspace = hashlib.sha256(token.encode()).hexdigest()[:16]
+
+    @classmethod
+    def fetch(cls, clubhouse_client):
+        """
+        Loads the elements from Clubhouse.
+        If a cache folder is configured ('clubhouse' / 'registry_cache'), the response is kept on disk and reused
+        for 'registry_ttl' seconds (default: 1 hour), in a file per workspace
+        """
+        folder = Config.get('clubhouse', {}).get('registry_cache')
+        name = "{}-{}.json".format(cls.urlbase, cls.workspace) if cls.workspace else "{}.json".format(cls.urlbase)
+        path = os.path.join(folder, name) if folder else None
+        ttl = Config.get('clubhouse', {}).get('registry_ttl', 3600)
+        if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < ttl:
+            logging.info("Loading '{}' from the cache".format(cls.urlbase))
+            with open(path) as f:
+                return json.load(f)
+        response = clubhouse_client.get(cls.urlbase)
+        if path:
+            os.makedirs(folder, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(response, f)
+        return response
 
     @classmethod
     def get_id(cls, ref):
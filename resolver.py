@@ -0,0 +1,96 @@
+from collections import defaultdict
+from config import Config
+from contextlib import contextmanager
+from registry import Members, EpicStates, StoryStates
+import contextvars
+import logging
+import threading
+
+class Resolver:
+    """
+    Maps the Jira references (user keys, status names, issue and link types) directly to their Clubhouse values,
+    by combining the configuration file with the Clubhouse registries.
+    The tables are compiled once, after the registries are loaded. The references that cannot be mapped are
+    collected while the projects are extracted, so that they are all reported at once before anything is written;
+    they are also collected per project (see scope), so that a project can be checked on its own.
+    Like the Config, the resolver is stored in class variables, accessible from all objects.
+    """
+    tables = {}  # kind -> {jira reference: clubhouse value}
+    missing = defaultdict(set)  # kind -> descriptions of the references that could not be mapped
+    project_missing = defaultdict(lambda: defaultdict(set))  # project key -> kind -> descriptions
+    _project = contextvars.ContextVar('project', default=None)  # key of the project being extracted (see scope)
+    _lock = threading.Lock()
+
+    # kind of reference -> registry holding the Clubhouse ids (None: the configured value is used as is)
+    registries = {
+        'users': Members,
+        'issue_states': StoryStates,
+        'epic_states': EpicStates,
+        'subtask_states': None,
+        'story_types': None,
+        'link_types': None,
+    }
+
+    @classmethod
+    def compile(cls):
+        """Builds the tables (the registries must have been initialized)"""
+        cls.tables = {}
+        cls.missing = defaultdict(set)
+        cls.project_missing = defaultdict(lambda: defaultdict(set))
+        for kind, registry in cls.registries.items():
+            mapping = Config.get(kind)
+            if registry:
+                cls.tables[kind] = {jira: registry.items[ch] for jira, ch in mapping.items() if ch in registry.items}
+            else:
+                cls.tables[kind] = dict(mapping)
+
+    @classmethod
+    def resolve(cls, kind, ref):
+        """
+        Returns the Clubhouse value for a Jira reference.
+        A reference mapped to null in the configuration gives None (= not migrated);
+        a reference that is not mapped gives None and is recorded as missing
+        """
+        table = cls.tables[kind]
+        if ref in table:
+            return table[ref]
+        mapping = Config.get(kind)
+        if ref not in mapping:
+            description = "'{}' (not in the configuration)".format(ref)
+        elif mapping[ref] is None:
+            return None
+        else:
+            description = "'{}' -> '{}' (not found in Clubhouse)".format(ref, mapping[ref])
+        with cls._lock:
+            cls.missing[kind].add(description)
+            if cls._project.get():
+                cls.project_missing[cls._project.get()][kind].add(description)
+        return None
+
+    @classmethod
+    @contextmanager
+    def scope(cls, project_key):
+        """Records the references that cannot be mapped in the block as references of the project
+        (the block may use parallel_map, which runs the items in the context of the caller)"""
+        token = cls._project.set(project_key)
+        try:
+            yield
+        finally:
+            cls._project.reset(token)
+
+    @classmethod
+    def user(cls, key):
+        return cls.resolve('users', key)
+
+    @classmethod
+    def check(cls, project_key=None):
+        """
+        Reports all the references found in the extracted data that could not be mapped
+        :param project_key: if given, only the references of this project are reported (see scope)
+        :return: True if there is none
+        """
+        missing = cls.project_missing.get(project_key, {}) if project_key else cls.missing
+        prefix = "Project '{}': ".format(project_key) if project_key else ""
+        for kind, descriptions in sorted(missing.items()):
+            logging.error("{}Unmapped {}: {}".format(prefix, kind, ", ".join(sorted(descriptions))))
+        return not any(missing.values())
@@ -0,0 +1,96 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+class Task:
+    """A write in the scheduler, with the tasks it depends on"""
+    def __init__(self, name, function, after):
+        self.name = name
+        self.function = function
+        self.after = [t for t in after if t]
+        self.children = []
+        self.waiting = len(self.after)
+        self.state = 'pending'  # then 'done', 'failed' or 'skipped' (when a task it depends on has failed)
+
+    def __str__(self):
+        return self.name
+
+
+class WriteScheduler:
+    """
+    Runs the writes to Clubhouse as a dependency graph (DAG): a task starts as soon as all the tasks
+    it depends on are done, and independent tasks run concurrently.
+    The rate limit and the retries are handled by the client (see concurrency.ThrottledClient).
+    If a task fails, the tasks that depend on it are skipped, the others carry on.
+    """
+    report_every = 5  # seconds between two throughput reports
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.tasks = []
+        self.errors = []
+        self._condition = threading.Condition()
+        self._executor = None
+        self._remaining = 0
+        self._done = 0
+
+    def add(self, name, function, after=()):
+        """
+        Adds a task to the graph
+        :param after: the tasks that must be done before this one (None values are ignored)
+        :return: the new task, to be used in the 'after' list of other tasks
+        """
+        task = Task(name, function, after)
+        for t in task.after:
+            t.children.append(task)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        """Runs all the tasks, and raises the first error (after all the tasks that could run are done)"""
+        started = time.monotonic()
+        self._remaining = len(self.tasks)
+        with ThreadPoolExecutor(max_workers=self.workers) as self._executor:
+            with self._condition:
+                for t in self.tasks:
+                    if t.waiting == 0:
+                        self._executor.submit(self._run, t)
+                while self._remaining:
+                    self._condition.wait(self.report_every)
+                    self._report(started)
+        for task, error in self.errors:
+            logging.error("{} failed: {}".format(task, error))
+        if self.errors:
+            raise self.errors[0][1]
+
+    def _run(self, task):
+        try:
+            task.function()
+            task.state = 'done'
+        except Exception as e:
+            task.state = 'failed'
+            self.errors.append((task, e))
+        with self._condition:
+            self._remaining -= 1
+            self._done += 1
+            for child in task.children:
+                if task.state == 'failed':
+                    self._skip(child)
+                elif child.state == 'pending':
+                    child.waiting -= 1
+                    if child.waiting == 0:
+                        self._executor.submit(self._run, child)
+            self._condition.notify_all()
+
+    def _skip(self, task):
+        if task.state == 'pending':
+            task.state = 'skipped'
+            self._remaining -= 1
+            logging.warning("{} skipped".format(task))
+            for child in task.children:
+                self._skip(child)
+
+    def _report(self, started):
+        elapsed = time.monotonic() - started
+        logging.info("Writes: {}/{} done ({:.1f}/s)".format(self._done, len(self.tasks), self._done / elapsed if elapsed else 0))
@@ -0,0 +1,87 @@
+from jira.resources import Issue, Sprint, User
+from jiratools import JiraTools
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+class Snapshot:
+    """
+    Local store (SQLite) of the raw Jira data consumed by the migration: issues (with their comments),
+    watchers and sprints.
+    The first run loads the whole project; the following runs only fetch the issues updated since the last run.
+    """
+    margin = 5  # minutes added to the refresh window, to absorb clock differences with the Jira server
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("create table if not exists issues (key text primary key, project text, updated text, raw text)")
+            self.db.execute("create table if not exists watchers (key text primary key, updated text, raw text)")
+            self.db.execute("create table if not exists sprints (id text primary key, raw text)")
+            self.db.execute("create table if not exists runs (project text primary key, started real, fields text)")
+
+    def refresh(self, jira, project):
+        """
+        Brings the local copy of a project up to date, and returns all its issues (as jira Issue resources)
+        """
+        started = time.time()
+        fields = json.dumps(sorted(JiraTools.fields()))
+        last = self._select_one("select started, fields from runs where project = ?", project)
+        if last and last[1] == fields:
+            minutes = math.ceil((started - last[0]) / 60) + self.margin
+            changed = JiraTools.get_issue_list(jira, project, ["updated >= '-{}m'".format(minutes)])
+            logging.info("Snapshot: {} issues updated in '{}' since the last run".format(len(changed), project))
+        else:  # first run, or the list of fields has changed: load everything
+            changed = JiraTools.get_issue_list(jira, project)
+            with self.lock, self.db:
+                self.db.execute("delete from issues where project = ?", (project,))
+            logging.info("Snapshot: {} issues loaded from '{}'".format(len(changed), project))
+        with self.lock, self.db:
+            self.db.executemany("insert or replace into issues values (?, ?, ?, ?)",
+                                [(i.key, project, i.fields.updated, json.dumps(i.raw)) for i in changed])
+        # issues that were deleted (or moved) in Jira are detected by comparing the counts
+        if last and JiraTools.count_issues(jira, project) != self._count(project):
+            keys = {i.key for i in JiraTools.get_issue_list(jira, project, fields=["key"])}
+            deleted = [k for (k,) in self._select("select key from issues where project = ?", project) if k not in keys]
+            with self.lock, self.db:
+                self.db.executemany("delete from issues where key = ?", [(k,) for k in deleted])
+            logging.info("Snapshot: {} issues removed from '{}'".format(len(deleted), project))
+        with self.lock, self.db:
+            self.db.execute("insert or replace into runs values (?, ?, ?)", (project, started, fields))
+        rows = self._select("select raw from issues where project = ? "
+                            "order by cast(substr(key, instr(key, '-') + 1) as integer)", project)
+        return [Issue(jira._options, jira._session, raw=json.loads(raw)) for (raw,) in rows]
+
+    def get_watchers(self, jira, issue):
+        """Returns the cached watchers of an issue, if the issue has not been updated since they were loaded"""
+        row = self._select_one("select raw from watchers where key = ? and updated = ?", issue.key, issue.fields.updated)
+        return [User(jira._options, jira._session, raw=raw) for raw in json.loads(row[0])] if row else None
+
+    def put_watchers(self, issue, watchers):
+        with self.lock, self.db:
+            self.db.execute("insert or replace into watchers values (?, ?, ?)",
+                            (issue.key, issue.fields.updated, json.dumps([w.raw for w in watchers])))
+
+    def get_sprint(self, jira, id):
+        row = self._select_one("select raw from sprints where id = ?", str(id))
+        return Sprint(jira._options, jira._session, raw=json.loads(row[0])) if row else None
+
+    def put_sprint(self, id, sprint):
+        with self.lock, self.db:
+            self.db.execute("insert or replace into sprints values (?, ?)", (str(id), json.dumps(sprint.raw)))
+
+    def _count(self, project):
+        return self._select_one("select count(*) from issues where project = ?", project)[0]
+
+    def _select(self, query, *params):
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def _select_one(self, query, *params):
+        with self.lock:
+            return self.db.execute(query, params).fetchone()
@@ -0,0 +1,108 @@
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib.parse import urlparse
+import clubhouse
+import copy
+import logging
+import requests
+import socket
+import threading
+import time
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections are kept open by TCP keep-alive probes while they wait in the pool"""
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def pool(session, workers=1):
+    """
+    Tunes a requests session for concurrent use: a pooled keep-alive connection per worker and per host
+    (requests keeps 10 by default, the connections opened beyond that are closed after each call),
+    and compressed answers
+    """
+    adapter = PooledAdapter(pool_connections=4, pool_maxsize=max(workers, DEFAULT_POOLSIZE))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    return session
+
+
+class SessionClient(clubhouse.ClubhouseClient):
+    """ClubhouseClient that sends its requests through a pooled session, instead of opening a connection per call"""
+    def __init__(self, api_key, workers=1):
+        super().__init__(api_key)
+        self.session = pool(requests.Session(), workers)
+
+    def _request(self, method, *segments, **kwargs):
+        if not segments[0].startswith(clubhouse.ENDPOINT_PATH):
+            segments = [clubhouse.ENDPOINT_PATH, *segments]
+        url = "/".join([clubhouse.ENDPOINT_HOST.rstrip("/"), *[str(s).strip("/") for s in segments]])
+        prefix = "&" if urlparse(url).query else "?"
+        response = self.session.request(method, url + "{}token={}".format(prefix, self.api_key), **kwargs)
+        if response.status_code > 299 and response.status_code not in self.ignored_status_codes:
+            logging.error("Status code: {}, Content: {}".format(response.status_code, response.text))
+            response.raise_for_status()
+        if response.status_code == 204:
+            return {}
+        return response.json()
+
+
+class CachedClient:
+    """
+    Wraps a REST client (e.g. the ThrottledClient) and keeps the answers of its GETs for a few seconds
+    ('clubhouse' / 'cache_ttl' in the configuration), so that the same listing is not requested twice.
+    A write drops the cached answers of the same resource: a post to 'stories' drops e.g. the GET of
+    'projects/<id>/stories', because the two paths share the collection 'stories'.
+    """
+    def __init__(self, client, ttl=30):
+        self.client = client
+        self.ttl = ttl
+        self._cache = {}  # (segments, params) -> (expiry, answer)
+        self._generation = 0  # number of writes: an answer received after a write that began later is not cached
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def collections(segments):
+        """Names of the resources of a path (the segments that are not ids)"""
+        return {str(s).strip("/") for s in segments if not str(s).isdigit()} - {'bulk'}
+
+    def get(self, *segments, **kwargs):
+        if not self.ttl or set(kwargs) - {'params'}:
+            return self.client.get(*segments, **kwargs)
+        key = (tuple(str(s) for s in segments), tuple(sorted((kwargs.get('params') or {}).items())))
+        with self._lock:
+            expiry, answer = self._cache.get(key, (0, None))
+            if expiry > time.monotonic():
+                return copy.deepcopy(answer)
+            generation = self._generation
+        answer = self.client.get(*segments, **kwargs)
+        with self._lock:
+            if generation == self._generation:
+                self._cache[key] = (time.monotonic() + self.ttl, copy.deepcopy(answer))
+        return answer
+
+    def post(self, *segments, **kwargs):
+        return self._write(self.client.post, segments, kwargs)
+
+    def put(self, *segments, **kwargs):
+        return self._write(self.client.put, segments, kwargs)
+
+    def delete(self, *segments, **kwargs):
+        return self._write(self.client.delete, segments, kwargs)
+
+    def _write(self, method, segments, kwargs):
+        self.invalidate(segments)
+        try:
+            return method(*segments, **kwargs)
+        finally:
+            self.invalidate(segments)  # the answers to GETs sent during the write may be out of date
+
+    def invalidate(self, segments):
+        written = self.collections(segments)
+        with self._lock:
+            self._generation += 1
+            for key in [k for k in self._cache if self.collections(k[0]) & written]:
+                del self._cache[key]